@@ -1,22 +1,52 @@
 # -*- coding: UTF-8 -*-
 # vim:ft=python:et:ts=4:sw=4:ai
 
+import base64
 import codecs
+import csv
+import gzip
+import hashlib
+import json
+import logging
+import lzma
 import mimetypes
+import os
 import re
+import shutil
+import tarfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
 from email.headerregistry import Address
 from email.message import EmailMessage
 from email.policy import SMTP
-from io import StringIO
-from os import mkdir, path
+from fnmatch import fnmatchcase
+from io import BufferedReader, RawIOBase, StringIO
+from os import path
+from struct import pack, unpack_from
 from sys import stderr
 from urllib.parse import quote as urlquote
+from uuid import uuid4
 
 import click
-
-from readms.metapst import get_internet_code_page
+from pytz import utc as UTC
+
+from readms.metapst import get_internet_code_page, prop_type_sizes
+from readms.pstindex import (
+    AttachmentIndex,
+    SizeIndex,
+    message_body_text,
+    open_message_index,
+)
 from readms.readpst import NDBLayer, PropertyContext, PropertyValue
 from readms.readutl import dump_hex
+from readms.writeole import MSG_CLSID, OLEWriter
+
+log = logging.getLogger(__name__)
 
 
 @click.group()
@@ -143,42 +173,146 @@ def print_messages(ctx, nids, binary_limit):
                 print(f'{pa.get_value("AttachSize"):>10,d} {att_name:<60s}')
 
 
+@cli.command('sizes', help='Извежда най-големите съобщения и папки')
+@click.option('--top', type=int, show_default=True, default=20, help='брой на извежданите')
+@click.option('--folder', type=int, default=None, help='само съобщенията в тази папка')
+@click.pass_context
+def print_sizes(ctx, top, folder):
+    pstfile = ctx.obj['pstfile']
+    with NDBLayer(pstfile) as ndb:
+        sizes = open_message_index(SizeIndex, ndb, pstfile, ndb._index_dir, "sizes")
+        print(f"{sizes.total_size():,d} bytes in {len(sizes.nids):,d} messages\n")
+
+        if folder is None:
+            print("="*60)
+            print("NORMAL_FOLDER\n")
+            print(f"{'nid':>9} {'count':>7} {'size':>14} {'name':<30}")
+            for nid, cnt, size in sizes.top_folders(top):
+                name = PropertyContext(ndb, nid).get_value_safe("DisplayName", "")
+                print(f"{nid:#9d} {cnt:#7,d} {size:#14,d} {name:<30}")
+            print()
+
+        print("="*60)
+        print("NORMAL_MESSAGE\n")
+        print(f"{'nid':>9} {'parent':>7} {'size':>14} {'subject':<30}")
+        for nid, nidp, size in sizes.top_messages(top, folder):
+            subject = PropertyContext(ndb, nid).get_value_safe("ConversationTopic", "")
+            print(f"{nid:#9d} {nidp:#7d} {size:#14,d} {subject:<30}")
+        print()
+
+        print("="*60)
+        print("DISTRIBUTION\n")
+        for limit, cnt, size in sizes.distribution(folder):
+            limit = f"<= {limit:,d}" if limit is not None else "more"
+            print(f"{limit:>16} {cnt:#9,d} {size:#16,d}")
+
+
 @cli.command('nltk', help='Извежда текста на съобщенията подходящо за NLTK')
 @click.argument('outfile', type=click.STRING)
+@click.option('--format', 'out_format', type=click.Choice(["text", "jsonl"]),
+              show_default=True, default="text",
+              help='разделени с BEGIN/END редове или по един JSON обект на ред')
+@click.option('--jobs', type=int, show_default=True, default=1,
+              help='брой на паралелните процеси; 0 за броя на процесорите')
 @click.pass_context
-def print_stat_messages(ctx, outfile):
-    progress = 0
-    with (NDBLayer(ctx.obj['pstfile']) as ndb,
-            codecs.open(outfile, "w+", "UTF-8") as out):
-        for nx in ndb._nbt:
-            if nx['typeCode'] != 'NORMAL_MESSAGE':
-                continue
-            pc = PropertyContext(ndb, nx['nid'])
-            print('-------BEGIN MESSAGE HEADER-------', file=out)
-            print(nx['nid'], file=out)
-            print(pc.get_value('MessageDeliveryTime'), file=out)
-            print(pc.get_value('ConversationTopic'), file=out)
-            print('-------BEGIN MESSAGE BODY-------', file=out)
-            print(pc.get_value('Body'), file=out)
-            print('-------END MESSAGE BODY-------', file=out)
-            progress += 1
-            if progress % 10 == 0:
-                print('.', file=stderr, end='', flush=True)
-    print(file=stderr)
+def print_stat_messages(ctx, outfile, out_format, jobs):
+    with NDBLayer(ctx.obj['pstfile']) as ndb:
+        nids = [nx['nid'] for nx in ndb._nbt if nx['typeCode'] == 'NORMAL_MESSAGE']
+        # Процесите връщат текста на цели групи съобщения, а тук той се
+        # записва в реда на nids - по позицията на данните им във файла
+        nids = ndb.physical_order(nids)
+        calls = ((pos, (nids[pos:pos+NLTK_BATCH], out_format))
+                 for pos in range(0, len(nids), NLTK_BATCH))
+        failed = 0
+        with open_corpus(outfile) as out:
+            for pos, (data, errors) in run_pipeline(ndb, None, nltk_messages, calls, jobs):
+                out.write(data)
+                for nid, error in errors:
+                    print(f"... failed {nid}: {error}", file=stderr)
+                done = min(pos + NLTK_BATCH, len(nids))
+                failed += len(errors)
+                print(f"... {done}/{len(nids)} messages", file=stderr)
+        if failed:
+            print(f"... {failed} failed", file=stderr)
+
+
+NLTK_BATCH = 256
+
+
+def open_corpus(outfile):
+    """Файл за текста, компресиран с gzip или xz според разширението."""
+
+    if outfile.endswith(".gz"):
+        return gzip.open(outfile, "wb")
+    if outfile.endswith(".xz"):
+        return lzma.open(outfile, "wb")
+    return open(outfile, "wb", buffering=1 << 22)
+
+
+def nltk_messages(ndb, target, nids, out_format):
+    """Текстът на съобщенията nids като UTF-8 и списък [nid, грешка].
+
+    Текстът е Body или, ако липсва, извлечен от Html или RtfCompressed
+    (виж message_body_text).
+    """
+
+    out = StringIO()
+    errors = []
+    for nid in ndb.schedule_reads(nids):
+        try:
+            pc = PropertyContext(ndb, nid)
+            delivery = pc.get_value('MessageDeliveryTime')
+            topic = pc.get_value('ConversationTopic')
+            body = message_body_text(pc)
+        except Exception as ex:  # noqa:BLE001
+            errors.append([nid, f"{type(ex).__name__}: {ex}"])
+            continue
+        if out_format == "jsonl":
+            record = {"nid": nid, "date": delivery.isoformat() if delivery else None,
+                      "subject": topic, "body": body}
+            print(json.dumps(record, ensure_ascii=False), file=out)
+            continue
+        print('-------BEGIN MESSAGE HEADER-------', file=out)
+        print(nid, file=out)
+        print(delivery, file=out)
+        print(topic, file=out)
+        print('-------BEGIN MESSAGE BODY-------', file=out)
+        print(body, file=out)
+        print('-------END MESSAGE BODY-------', file=out)
+    return out.getvalue().encode("UTF-8", "replace"), errors
 
 
 # https://docs.fileformat.com/email/
 @cli.command('export', help='Извежда съобщения в широко изпозлвани формати')
-@click.argument('opath', type=click.Path(exists=True, dir_okay=True))
+@click.argument('opath', type=click.Path(dir_okay=True, allow_dash=True))
 @click.argument('nids', nargs=-1, type=int)
 @click.option('--folders', is_flag=True, show_default=True,
               help='извежда всички съобщения като счита зададените nids за идентификатори на папки')
 @click.option('--plain', is_flag=True, show_default=True,
               help='като сглобени файлове в папка (нестандартно)')
 @click.option('--eml', is_flag=True, show_default=True, help='като eml RFC-822')
-@click.option('--outlook', is_flag=True, show_default=True, help='TODO като Outlook msg')
+@click.option('--outlook', is_flag=True, show_default=True, help='като Outlook msg')
+@click.option('--mbox', is_flag=True, show_default=True,
+              help='като mbox RFC-4155, по един файл за папка')
+@click.option('--jobs', type=int, show_default=True, default=1,
+              help='брой на паралелните процеси; 0 за броя на процесорите')
+@click.option('--restart', is_flag=True, show_default=True,
+              help='започва отначало, без да пропуска вече изведените съобщения')
+@click.option('--dedup', is_flag=True, show_default=True,
+              help='записва еднаквите приложени файлове веднъж в blobs/ и ги свързва с hardlink')
 @click.pass_context
-def export_messages(ctx, nids, folders, opath, plain, eml, outlook):
+def export_messages(ctx, nids, folders, opath, plain, eml, outlook, mbox, jobs, restart,
+                    dedup):
+    formats = tuple(x for x, flag in (("plain", plain), ("eml", eml),
+                                      ("outlook", outlook), ("mbox", mbox)) if flag)
+    archive_mode = archive_open_mode(opath)
+    if archive_mode is None and not path.isdir(opath):
+        raise click.BadParameter(f"{opath} не е директория или архив", param_hint="OPATH")
+    if archive_mode is not None and (mbox or dedup or jobs != 1):
+        raise click.UsageError("--mbox, --dedup и --jobs не се поддържат при извеждане в архив")
+    # При извеждане на stdout съобщенията за напредъка са в stderr
+    progress = stderr if opath == "-" else None
+
     with NDBLayer(ctx.obj['pstfile']) as ndb:
         all_nids = {}
         if folders:
@@ -193,32 +327,78 @@ def export_messages(ctx, nids, folders, opath, plain, eml, outlook):
         else:
             all_nids[''] = nids
 
+        tasks = []
+        for pdir, pdir_nids in all_nids.items():
+            for nid in pdir_nids:
+                tasks.append((pdir, nid, f"{pdir}/{nid}" if pdir else f"{nid}"))
+
+        # Съобщенията се четат по реда на блоковете им във файла
+        offsets = {nid: ndb.nid_offset(nid) for _, nid, _ in tasks}
+        tasks.sort(key=lambda task: offsets[task[1]])
+
         index = {}
-        for pdir, nids in all_nids.items():
-            odir = path.join(opath, pdir)
-            if not path.exists(odir):
-                mkdir(odir)
-            for nid in nids:
-                ofile = path.join(odir, f"{nid}")
-                print(f"... export {nid} -> {ofile}")
-
-                if plain:
-                    index_data = export_plain(ndb, ofile, nid)
-                    if folders:
-                        if pdir not in index:
-                            index[pdir] = []
-                        index[pdir].append(index_data)
-                if eml:
-                    export_eml(ndb, ofile, nid)
-                if outlook:
-                    export_outlook(ndb, ofile, nid)
-
-        # Извеждане на индекса
-        if index:
+
+        def add_index(pdir, nid, index_data):
+            if plain and folders:
+                if pdir not in index:
+                    index[pdir] = {}
+                index[pdir][nid] = index_data
+
+        mboxes = {}
+        mbox_files = ExitStack()
+
+        def get_mbox(pdir):
+            if pdir not in mboxes:
+                mbox_fnm = f"{pdir or 'messages'}.mbox"
+                mboxes[pdir] = mbox_files.enter_context(
+                    MboxWriter(path.join(opath, mbox_fnm), manifest.mbox_size(mbox_fnm)))
+            return mboxes[pdir]
+
+        with (open_export_target(opath, archive_mode, dedup) as target,
+                ExportManifest(opath, "+".join(formats), restart,
+                               persistent=archive_mode is None) as manifest):
+            # Вече изведените съобщения се пропускат, а индексът им се взема от манифеста
+            todo = []
+            for pdir, nid, name in tasks:
+                record = manifest.get_done(nid)
+                if record is None:
+                    todo.append((pdir, nid, name))
+                else:
+                    add_index(pdir, nid, record.get("index"))
+            if len(todo) < len(tasks):
+                print(f"... skip {len(tasks) - len(todo)} already exported", file=progress)
+
+            failed = 0
+            with mbox_files:
+                results = export_pipeline(ndb, target, todo, jobs, formats)
+                for (pdir, nid, name), record in results:
+                    if "mbox" in record:
+                        mbox_out = get_mbox(pdir)
+                        offset, length = mbox_out.append(record["mbox"])
+                        record["mbox"] = [path.relpath(mbox_out.file_name, opath),
+                                          offset, length]
+                    manifest.append(record)
+                    if "error" in record:
+                        failed += 1
+                        print(f"... failed {nid}: {record['error']}", file=stderr)
+                        continue
+                    print(f"... export {nid} -> {name}", file=progress)
+                    add_index(pdir, nid, record.get("index"))
+            if failed:
+                print(f"... {failed} failed, see {manifest.file_name or 'above'}", file=stderr)
+
+            # Индекс с позициите на съобщенията в mbox файловете
+            if mbox:
+                write_mbox_index(opath, manifest)
+
+            # Извеждане на индекса
             for pdir, pdir_index in index.items():
-                with open(path.join(opath, pdir, "index.html"), "w", encoding="UTF-8") as fout:
+                with text_member(target, f"{pdir}/index.html") as fout:
                     print("<html><body><ul>", file=fout)
-                    for entry in pdir_index:
+                    for nid in all_nids[pdir]:
+                        entry = pdir_index.get(nid)
+                        if entry is None:
+                            continue
                         print("<li>"
                               f"<a href='{entry['nid']}/{entry['link']}'>"
                               f"{entry['subject']}</a>"
@@ -227,6 +407,601 @@ def export_messages(ctx, nids, folders, opath, plain, eml, outlook):
                     print("</ul></body></html>", file=fout)
 
 
+@cli.command('attachments', help='Извежда приложените файлове, които отговарят на филтрите')
+@click.argument('opath', type=click.Path(file_okay=False, dir_okay=True))
+@click.option('--ext', 'extensions', multiple=True, help='разширение на файла, напр. pdf')
+@click.option('--mime', 'mime_types', multiple=True,
+              help='MIME тип, напр. application/pdf или image/*')
+@click.option('--min-size', type=int, default=None, help='най-малък размер в байтове')
+@click.option('--max-size', type=int, default=None, help='най-голям размер в байтове')
+@click.option('--folder', 'folders', type=int, multiple=True,
+              help='само от съобщенията в тази папка')
+@click.option('--jobs', type=int, show_default=True, default=1,
+              help='брой на паралелните процеси; 0 за броя на процесорите')
+@click.option('--dedup', is_flag=True, show_default=True,
+              help='записва еднаквите приложени файлове веднъж в blobs/ и ги свързва с hardlink')
+@click.pass_context
+def export_attachments(ctx, opath, extensions, mime_types, min_size, max_size, folders,
+                       jobs, dedup):
+    if not path.isdir(opath):
+        raise click.BadParameter(f"{opath} не е директория", param_hint="OPATH")
+    att_filter = AttachmentFilter(extensions, mime_types, min_size, max_size)
+
+    pstfile = ctx.obj['pstfile']
+    with NDBLayer(pstfile) as ndb:
+        # Филтрите се прилагат върху индекса с името, размера и MIME типа на
+        # приложенията, така че от pst файла се четат само избраните
+        index = open_message_index(AttachmentIndex, ndb, pstfile, ndb._index_dir,
+                                   "attachments")
+        selected = {}
+        for nid in index.message_nids():
+            nx = ndb._nbtx.get(nid)
+            if nx is None or (folders and nx["nidParent"] not in folders):
+                continue
+            infos = [x for x in index.attachments(nid) if att_filter.match(x)]
+            if infos:
+                selected[nid] = (nx["nidParent"], infos)
+        print(f"... {sum(len(x[1]) for x in selected.values())} attachments "
+              f"in {len(selected)} messages")
+
+        calls = ((nid, (f"{pdir}/{nid}", nid, [x.anid for x in infos]))
+                 for nid in ndb.physical_order(selected)
+                 for pdir, infos in (selected[nid],))
+        csv_name = path.join(opath, "attachments.csv")
+        with (DirectoryTarget(opath, dedup) as target,
+                open(csv_name, "w", encoding="UTF-8", newline="") as fcsv):
+            writer = csv.writer(fcsv)
+            writer.writerow(("folder", "nid", "anid", "name", "mime", "size",
+                             "file", "sha256", "error"))
+            failed = 0
+            for nid, record in run_pipeline(ndb, target, extract_attachments, calls, jobs,
+                                            key_nid=lambda nid: nid):
+                pdir, infos = selected[nid]
+                files = {anid: (file_name, sha) for anid, file_name, sha in record["files"]}
+                for info in infos:
+                    file_name, sha = files.get(info.anid, ("", ""))
+                    writer.writerow((pdir, nid, info.anid, info.name or "",
+                                     att_filter.mime_type(info), info.size, file_name, sha,
+                                     record.get("error", "") if not file_name else ""))
+                    if file_name:
+                        print(f"... extract {file_name}")
+                if "error" in record:
+                    failed += 1
+                    print(f"... failed {nid}: {record['error']}", file=stderr)
+            if failed:
+                print(f"... {failed} failed, see {csv_name}", file=stderr)
+
+
+class AttachmentFilter:
+    """Филтър на приложените файлове по разширение, MIME тип и размер.
+
+    Проверява се записът AttachmentInfo от индекса; размерът е AttachSize.
+    MIME типът е AttachMimeTag или, ако липсва, се определя по името, като
+    mime_types може да съдържа и шаблони (image/*).
+    """
+
+    def __init__(self, extensions=(), mime_types=(), min_size=None, max_size=None):
+        self.extensions = {x.lower().lstrip(".") for x in extensions}
+        self.mime_types = [x.lower() for x in mime_types]
+        self.min_size = min_size
+        self.max_size = max_size
+
+    @staticmethod
+    def mime_type(info):
+        if info.mime:
+            return info.mime
+        return mimetypes.guess_type(info.name or "")[0] or "application/octet-stream"
+
+    def match(self, info):
+        if self.extensions and AttachmentIndex.extension(info.name) not in self.extensions:
+            return False
+        if self.mime_types:
+            mime = self.mime_type(info).lower()
+            if not any(fnmatchcase(mime, x) for x in self.mime_types):
+                return False
+        if self.min_size is not None and info.size < self.min_size:
+            return False
+        return self.max_size is None or info.size <= self.max_size
+
+
+def attachment_file_name(att_name, anid, used):
+    """Името на файла за приложението anid, уникално в used (и се добавя в него).
+
+    Взема се само последната част от att_name, за да не се излиза от папката
+    на съобщението. Без име се използва attachment-<anid>.
+    """
+
+    file_name = path.basename((att_name or "").replace("\\", "/"))
+    if file_name in ("", ".", ".."):
+        file_name = f"attachment-{anid}"
+    if file_name in used:
+        stem, ext = path.splitext(file_name)
+        file_name = f"{stem}-{anid}{ext}"
+    used.add(file_name)
+    return file_name
+
+
+def extract_attachments(ndb, target, name, nid, anids):
+    """Извежда приложенията anids на съобщението nid в папка name.
+
+    Връща записа {"nid", "files": [[anid, файл, sha256], ...]}, а при грешка
+    и "error", като изведените дотогава файлове остават в "files".
+    """
+
+    record = {"nid": nid, "files": []}
+    used = set()
+    try:
+        for anid in anids:
+            pa = PropertyContext(ndb, nid, anid)
+            if pa.get_value_safe("AttachMethod") == 5:
+                # вложено съобщение (afEmbeddedMessage), няма файл
+                continue
+            att_name = pa.alt_name("AttachLongFilename", "DisplayName", "AttachFilename")
+            file_name = attachment_file_name(pa.get_value(att_name), anid, used)
+
+            size, chunks = pa.get_stream("AttachDataObject") or (0, ())
+            target.add_blob(f"{name}/{file_name}", chunks, size)
+            record["files"].extend([anid, *x] for x in target.take_written())
+    except Exception as ex:  # noqa:BLE001
+        target.take_written()
+        record["error"] = f"{type(ex).__name__}: {ex}"
+    return record
+
+
+class ExportManifest:
+    """Append-only манифест на извеждането в opath/export_manifest.jsonl.
+
+    Всеки ред е JSON запис за едно съобщение: nid, режим на извеждане,
+    изведените файлове (път спрямо opath и sha256) и данните за индекса,
+    или грешката, поради която не е изведено. При повторно извеждане в
+    същия режим съобщенията, чиито файлове съществуват, се пропускат, а
+    тези с грешка се опитват отново. Валиден е последният запис за nid.
+
+    При persistent=False (извеждане в архив) записите са само в паметта.
+    """
+
+    def __init__(self, opath, mode, restart=False, persistent=True):
+        self._opath = opath
+        self._mode = mode
+        self.file_name = None
+        self.done = {}
+        self.failed = {}
+        self._fout = None
+        self._resources = ExitStack()
+        if not persistent:
+            return
+        self.file_name = path.join(opath, "export_manifest.jsonl")
+        if restart and path.exists(self.file_name):
+            os.remove(self.file_name)
+        need_eol = self._load()
+        with ExitStack() as stack:
+            self._fout = stack.enter_context(open(self.file_name, "a", encoding="UTF-8"))
+            if need_eol:
+                self._fout.write("\n")
+            self._resources = stack.pop_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        self._resources.close()
+
+    def _load(self):
+        if not path.exists(self.file_name):
+            return False
+        line = "\n"
+        with open(self.file_name, encoding="UTF-8") as fin:
+            for line in fin:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # недописан ред при прекъснато извеждане
+                    continue
+                if record.get("mode") == self._mode:
+                    self._update(record)
+        return not line.endswith("\n")
+
+    def _update(self, record):
+        nid = record["nid"]
+        if "error" in record:
+            self.done.pop(nid, None)
+            self.failed[nid] = record
+        else:
+            self.failed.pop(nid, None)
+            self.done[nid] = record
+
+    def get_done(self, nid):
+        """Записът за вече изведеното съобщение или None."""
+
+        record = self.done.get(nid)
+        if record is None:
+            return None
+        for fnm, _checksum in record["files"]:
+            if not path.exists(path.join(self._opath, fnm)):
+                return None
+        if "mbox" in record:
+            fnm, offset, length = record["mbox"]
+            fnm = path.join(self._opath, fnm)
+            if not path.exists(fnm) or path.getsize(fnm) < offset + length:
+                return None
+        return record
+
+    def mbox_size(self, mbox_fnm):
+        """Размерът на mbox файла, до който съобщенията в него са изведени.
+
+        Съобщенията, останали в буфера при прекъснато извеждане, не се отчитат.
+        """
+
+        fnm = path.join(self._opath, mbox_fnm)
+        file_size = path.getsize(fnm) if path.exists(fnm) else 0
+        size = 0
+        for record in self.done.values():
+            fnm, offset, length = record.get("mbox", (None, 0, 0))
+            if fnm == mbox_fnm and offset + length <= file_size:
+                size = max(size, offset + length)
+        return size
+
+    def append(self, record):
+        record = dict(record, mode=self._mode)
+        if self._fout is not None:
+            self._fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._fout.flush()
+        self._update(record)
+
+
+class ExportTarget:
+    """Място, в което се извеждат файловете на съобщенията.
+
+    Файловете се задават с име (път с / спрямо началото) и итератор по
+    части от съдържанието им, така че големи приложени файлове се копират
+    от pst файла, без да се събират в паметта. Докато се записва, се
+    изчислява sha256 на всеки файл; take_written връща [име, sha256] на
+    записаните след последното извикване.
+    """
+
+    def __init__(self):
+        self._written = []
+        # отворените от наследниците архиви, които затваря close
+        self._resources = ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        self._resources.close()
+
+    def add(self, name, chunks, size=None):
+        sha = hashlib.sha256()
+
+        def hashed():
+            for chunk in chunks:
+                sha.update(chunk)
+                yield chunk
+
+        self._write(name, hashed(), size)
+        self._written.append([name, sha.hexdigest()])
+
+    def _write(self, name, chunks, size):
+        raise NotImplementedError
+
+    def add_blob(self, name, chunks, size=None):
+        """Добавя приложен файл; виж DirectoryTarget за dedup."""
+
+        self.add(name, chunks, size)
+
+    def take_written(self):
+        written, self._written = self._written, []
+        return written
+
+
+class DirectoryTarget(ExportTarget):
+    """Извежда в директория.
+
+    При dedup приложените файлове се записват веднъж в blobs/<sha256>, а в
+    папката на съобщението се създава hardlink към тях. sha256 се изчислява
+    при четенето от pst файла във временен файл, който се премахва, ако
+    същото съдържание вече е записано.
+    """
+
+    def __init__(self, opath, dedup=False):
+        ExportTarget.__init__(self)
+        self._opath = opath
+        self._dedup = dedup
+
+    def _file_name(self, name):
+        file_name = path.join(self._opath, *name.split("/"))
+        os.makedirs(path.dirname(file_name), exist_ok=True)
+        return file_name
+
+    def _write(self, name, chunks, size):
+        with open(self._file_name(name), "wb") as fout:
+            fout.writelines(chunks)
+
+    def add_blob(self, name, chunks, size=None):
+        if not self._dedup:
+            self.add(name, chunks, size)
+            return
+
+        sha = hashlib.sha256()
+        tmp_name = self._file_name(f"blobs/tmp-{uuid4().hex}")
+        try:
+            with open(tmp_name, "wb") as fout:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    fout.write(chunk)
+            digest = sha.hexdigest()
+            blob_name = self._file_name(f"blobs/{digest[:2]}/{digest}")
+            if path.exists(blob_name):
+                os.remove(tmp_name)
+            else:
+                os.replace(tmp_name, blob_name)
+        finally:
+            if path.exists(tmp_name):
+                os.remove(tmp_name)
+
+        file_name = self._file_name(name)
+        if path.exists(file_name):
+            os.remove(file_name)
+        try:
+            os.link(blob_name, file_name)
+        except OSError:
+            # файловата система не поддържа hardlink
+            shutil.copyfile(blob_name, file_name)
+        self._written.append([name, digest])
+
+
+class ZipTarget(ExportTarget):
+    """Извежда в zip архив; fout е име на файл или отворен файл (stdout)."""
+
+    def __init__(self, fout):
+        ExportTarget.__init__(self)
+        with ExitStack() as stack:
+            self._zip = stack.enter_context(
+                zipfile.ZipFile(fout, "w", compression=zipfile.ZIP_DEFLATED))
+            self._resources = stack.pop_all()
+
+    def _write(self, name, chunks, size):
+        with self._zip.open(name, "w", force_zip64=True) as fout:
+            for chunk in chunks:
+                fout.write(chunk)
+
+
+class TarTarget(ExportTarget):
+    """Извежда в tar поток; размерът на всеки файл се записва преди съдържанието му.
+
+    fout е име на файл, който tarfile отваря и затваря, или отворен файл (stdout).
+    """
+
+    def __init__(self, fout, mode):
+        ExportTarget.__init__(self)
+        target = {"name": fout} if isinstance(fout, str) else {"fileobj": fout}
+        with ExitStack() as stack:
+            self._tar = stack.enter_context(tarfile.open(mode=mode, **target))
+            self._resources = stack.pop_all()
+
+    def _write(self, name, chunks, size):
+        if size is None:
+            data = b"".join(chunks)
+            size = len(data)
+            chunks = (data,)
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        self._tar.addfile(info, BufferedReader(_ChunkReader(chunks), 1 << 16))
+
+
+class _ChunkReader(RawIOBase):
+    """Файл само за четене върху итератор от части (bytes, memoryview)."""
+
+    def __init__(self, chunks):
+        RawIOBase.__init__(self)
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buf = memoryview(chunk).cast("B")
+        size = min(len(b), len(self._buf))
+        b[:size] = self._buf[:size]
+        self._buf = self._buf[size:]
+        return size
+
+
+ARCHIVE_MODES = ((".zip", "zip"), (".tar", "w|"), (".tar.gz", "w|gz"), (".tgz", "w|gz"),
+                 (".tar.bz2", "w|bz2"), (".tar.xz", "w|xz"), (".txz", "w|xz"))
+
+
+def archive_open_mode(opath):
+    """Вида на архива според разширението на opath; - е tar в stdout, None е директория."""
+
+    if opath == "-":
+        return "w|"
+    for ext, mode in ARCHIVE_MODES:
+        if opath.lower().endswith(ext):
+            return mode
+    return None
+
+
+def open_export_target(opath, archive_mode, dedup=False):
+    if archive_mode is None:
+        return DirectoryTarget(opath, dedup)
+    # архивът сам отваря и затваря файла opath, а stdout остава отворен
+    fout = click.get_binary_stream("stdout") if opath == "-" else opath
+    if archive_mode == "zip":
+        return ZipTarget(fout)
+    return TarTarget(fout, archive_mode)
+
+
+class MboxWriter:
+    """Добавя съобщения в mbox файл (RFC 4155) с големи буферирани записи.
+
+    Файлът се отрязва до size, т.е. до края на последното съобщение, което
+    е записано в манифеста; така при повторно извеждане не остават части от
+    прекъснато съобщение.
+    """
+
+    def __init__(self, file_name, size=0, buffer_size=1 << 22):
+        self.file_name = file_name
+        with ExitStack() as stack:
+            self._fout = stack.enter_context(
+                open(file_name, "r+b" if path.exists(file_name) else "wb",
+                     buffering=buffer_size))
+            self._fout.truncate(size)
+            self._fout.seek(size)
+            self._resources = stack.pop_all()
+        self._pos = size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        self._resources.close()
+
+    def append(self, data):
+        """Записва съобщението (вече с From_ ред) и връща (позиция, дължина)."""
+
+        offset = self._pos
+        self._fout.write(data)
+        self._pos += len(data)
+        return offset, len(data)
+
+
+def mbox_message(out):
+    """Съобщението out като mbox запис: From_ ред, mboxrd quoting и празен ред."""
+
+    sender = "MAILER-DAEMON"
+    if out["From"] is not None and out["From"].addresses:
+        sender = out["From"].addresses[0].addr_spec or sender
+    date = out["Date"].datetime if out["Date"] is not None else None
+    date = (date or datetime.now(UTC)).astimezone(UTC)
+
+    data = out.as_bytes(policy=SMTP.clone(linesep="\n"))
+    data = re.sub(rb"^(>*From )", rb">\1", data, flags=re.MULTILINE)
+    if not data.endswith(b"\n"):
+        data += b"\n"
+    return b"".join((f"From {sender} {date:%a %b %d %H:%M:%S %Y}\n".encode("ASCII"),
+                     data, b"\n"))
+
+
+def write_mbox_index(opath, manifest):
+    """Записва <mbox>.idx с редове nid<TAB>позиция<TAB>дължина за всеки mbox файл."""
+
+    entries = {}
+    for nid, record in manifest.done.items():
+        if "mbox" in record:
+            fnm, offset, length = record["mbox"]
+            entries.setdefault(fnm, []).append((offset, length, nid))
+    for fnm, mbox_entries in entries.items():
+        with open(path.join(opath, f"{fnm}.idx"), "w", encoding="UTF-8") as fout:
+            for offset, length, nid in sorted(mbox_entries):
+                fout.write(f"{nid}\t{offset}\t{length}\n")
+
+
+def export_one(ndb, target, name, nid, formats):
+    """Извежда съобщението nid във formats под name и връща записа за манифеста.
+
+    При mbox съобщението се връща в записа, за да се добави от единствения
+    процес, който пише в mbox файла. Грешка при извеждането не прекъсва
+    работата, а се записва в манифеста.
+    """
+
+    plain, eml, outlook, mbox = (x in formats for x in ("plain", "eml", "outlook", "mbox"))
+    record = {"nid": nid}
+    try:
+        if plain:
+            record["index"] = export_plain(ndb, target, name, nid)
+        if eml:
+            export_eml(ndb, target, name, nid)
+        if outlook:
+            export_outlook(ndb, target, name, nid)
+        if mbox:
+            record["mbox"] = mbox_message(build_eml(ndb, nid)[0])
+        record["files"] = target.take_written()
+    except Exception as ex:  # noqa:BLE001
+        target.take_written()
+        record.pop("index", None)
+        record.pop("mbox", None)
+        record["error"] = f"{type(ex).__name__}: {ex}"
+    return record
+
+
+def export_pipeline(ndb, target, tasks, jobs, formats, queue_size=4):
+    """Извежда съобщенията от tasks (pdir, nid, name) и връща (task, record)."""
+
+    calls = ((task, (task[2], task[1], formats)) for task in tasks)
+    return run_pipeline(ndb, target, export_one, calls, jobs, queue_size,
+                        key_nid=lambda task: task[1])
+
+
+def run_pipeline(ndb, target, func, calls, jobs, queue_size=4, key_nid=None):
+    """Изпълнява func(ndb, target, *args) за (key, args) от calls и връща (key, резултат).
+
+    При jobs > 1 всеки процес отваря собствен NDBLayer и DirectoryTarget в
+    директорията на target (или без target, ако е None) и записва сам
+    файловете; резултатите се връщат в реда на calls, като в обработка са
+    най-много jobs * queue_size задачи. func трябва да е функция от модула,
+    за да се предаде на процесите.
+
+    Ако key_nid(key) дава nid на съобщението, при jobs == 1 calls се
+    подреждат и блоковете им се четат на групи с NDBLayer.schedule_reads.
+    """
+
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        if key_nid is not None:
+            calls = ndb.schedule_reads(calls, key=lambda call: key_nid(call[0]))
+        for key, args in calls:
+            yield key, func(ndb, target, *args)
+        return
+
+    initargs = (ndb._file_name, ndb._index_dir,
+                target._opath if target is not None else None,
+                target._dedup if target is not None else False)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_export_init,
+                             initargs=initargs) as pool:
+        pending = deque()
+        for key, args in calls:
+            pending.append((key, pool.submit(_export_task, func, args)))
+            if len(pending) >= jobs * queue_size:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+
+_export_ndb = None
+_export_target = None
+
+
+def _export_init(file_name, index_dir, opath, dedup):
+    global _export_ndb, _export_target
+    _export_ndb = NDBLayer(file_name, index_dir)
+    _export_target = DirectoryTarget(opath, dedup) if opath is not None else None
+
+
+def _export_task(func, args):
+    return func(_export_ndb, _export_target, *args)
+
+
 class EmailExport:
     def __init__(self, pc):
         self.pc = pc
@@ -257,17 +1032,29 @@ class EmailExport:
             return codecs.decode(pv.data, self.get_encoding(), "replace")
         return None
 
-    def get_attachments(self, ndb, nid):
+    def get_attachment_contexts(self, ndb, nid):
         for anid, snid in ndb.list_nids("ATTACHMENT", nid):
             pa = PropertyContext(ndb, anid, snid)
             att_name = pa.alt_name("AttachLongFilename", "DisplayName", "AttachFilename")
             att_name = pa.get_value(att_name)
-            att = pa.get_value("AttachDataObject")
             cid = pa.get_value('AttachContentId')
-            yield att_name, cid, anid, att
+            yield att_name, cid, anid, pa
 
+    def get_attachments(self, ndb, nid):
+        for att_name, cid, anid, pa in self.get_attachment_contexts(ndb, nid):
+            yield att_name, cid, anid, pa.get_value("AttachDataObject")
+
+
+@contextmanager
+def text_member(target, name, encoding="UTF-8", errors="strict"):
+    """Събира текста, записан във fout, и го добавя в target като name."""
+
+    fout = StringIO()
+    yield fout
+    target.add(name, [fout.getvalue().encode(encoding, errors)])
 
-def export_plain(ndb, odir, nid):
+
+def export_plain(ndb, target, name, nid):
     pc = PropertyContext(ndb, nid)
     ee = EmailExport(pc)
     index_data = {'nid': nid}
@@ -283,23 +1070,25 @@ def export_plain(ndb, odir, nid):
     # (1) Plain text на съобщението
     pv = pc.get_value("Body")
     if pv is not None:
-        with open(path.join(odir, "body.txt"), "w", encoding="UTF-8") as fout:
+        with text_member(target, f"{name}/body.txt") as fout:
             fout.write(pv)
             index_data['link'] = 'body.txt'
 
     # (2) Приложени файлове
     attached_cid = {}
-    for att_name, cid, anid, att in ee.get_attachments(ndb, nid):
-        with open(path.join(odir, att_name), "wb+") as fout:
-            fout.write(att.data)
-        attached_cid[cid or anid] = att_name
+    used = set()
+    for att_name, cid, anid, pa in ee.get_attachment_contexts(ndb, nid):
+        file_name = attachment_file_name(att_name, anid, used)
+        size, chunks = pa.get_stream("AttachDataObject") or (0, ())
+        target.add_blob(f"{name}/{file_name}", chunks, size)
+        attached_cid[cid or anid] = file_name
 
     # (3) Съобщението като HTML
     html_text = ee.get_html()
     if html_text is not None:
-        with open(path.join(odir, "body.html"), "w",
-                  encoding=ee.get_encoding(),
-                  errors='replace') as fout:
+        with text_member(target, f"{name}/body.html",
+                         encoding=ee.get_encoding(),
+                         errors='replace') as fout:
 
             def fout_print(x):
                 if x is not None:
@@ -354,7 +1143,14 @@ def export_plain(ndb, odir, nid):
 
 
 # https://datatracker.ietf.org/doc/html/rfc5322.html
-def export_eml(ndb, ofile, nid):
+def build_eml(ndb, nid, streams=None):
+    """Съобщението nid като EmailMessage.
+
+    Ако е зададен речник streams, приложените файлове не се четат, а се
+    добавят празни и в streams се записва id(част) -> (размер, части) за
+    поточното им извеждане с mime_stream.
+    """
+
     index_data = {'nid': nid}
     pc = PropertyContext(ndb, nid)
     ee = EmailExport(pc)
@@ -396,8 +1192,9 @@ def export_eml(ndb, ofile, nid):
         html_part = out.get_payload()[-1]
 
     # (6) Приложените файлове и връзка с inline картинки
-    for att_name, cid, _anid, att in ee.get_attachments(ndb, nid):
+    for att_name, cid, _anid, pa in ee.get_attachment_contexts(ndb, nid):
         ctype, encoding = mimetypes.guess_type(att_name)
+        data = pa.get_value("AttachDataObject").data if streams is None else b""
 
         if ctype is None or encoding is not None:
             ctype = 'application/octet-stream'
@@ -406,20 +1203,237 @@ def export_eml(ndb, ofile, nid):
 
         if html_part is not None and is_inline and ctype is not None:
             ftype, fext = ctype.split("/")
-            html_part.add_related(att.data, ftype, fext, cid=cid)
+            html_part.add_related(data, ftype, fext, cid=cid)
+            att_part = html_part.get_payload()[-1]
         else:
-            out.add_attachment(att.data, maintype=maintype, subtype=subtype, filename=att_name)
-
-    index_data["link"] = f"{ofile}.eml"
-    with open(index_data["link"], 'wb') as fout:
-        fout.write(out.as_bytes(policy=SMTP))
+            out.add_attachment(data, maintype=maintype, subtype=subtype, filename=att_name)
+            att_part = out.get_payload()[-1]
+        if streams is not None:
+            streams[id(att_part)] = pa.get_stream("AttachDataObject") or (0, ())
+
+    return out, index_data
+
+
+def mime_stream(out, streams, policy=SMTP):
+    """Поточно сериализиране на out, създадено от build_eml със streams.
+
+    Връща (размер, части). Заглавните редове и текстовите части се
+    сериализират от email, а приложените файлове се кодират в base64 по
+    части при итериране, така че никой от тях не е в паметта изцяло.
+    Размерът е точен и се знае преди да се прочетат приложените файлове.
+    """
+
+    segments = list(_mime_segments(out, streams, policy))
+    size = sum(len(x) if isinstance(x, bytes) else x[0] for x in segments)
+
+    def chunks():
+        for x in segments:
+            if isinstance(x, bytes):
+                yield x
+            else:
+                yield from x[1]
+
+    return size, chunks()
+
+
+def _mime_segments(part, streams, policy):
+    crlf = policy.linesep.encode("ASCII")
+    if part.is_multipart():
+        boundary = part.get_boundary()
+        if boundary is None:
+            boundary = f"==============={uuid4().hex}=="
+            part.set_boundary(boundary)
+        boundary = boundary.encode("ASCII")
+        yield _mime_headers(part, policy)
+        for pos, subpart in enumerate(part.iter_parts()):
+            yield (crlf if pos > 0 else b"") + b"--" + boundary + crlf
+            yield from _mime_segments(subpart, streams, policy)
+        yield crlf + b"--" + boundary + b"--" + crlf
+    elif id(part) in streams:
+        size, chunks = streams[id(part)]
+        yield _mime_headers(part, policy)
+        yield _base64_size(size, len(crlf)), _base64_chunks(chunks, crlf)
+    else:
+        yield part.as_bytes(policy=policy)
+
+
+def _mime_headers(part, policy):
+    lines = [policy.fold_binary(name, value) for name, value in part.items()]
+    lines.append(policy.linesep.encode("ASCII"))
+    return b"".join(lines)
+
+
+# base64.encodebytes кодира по 57 байта на ред от 76 знака
+BASE64_LINE = 57
+
+
+def _base64_size(size, eol_size):
+    lines, rest = divmod(size, BASE64_LINE)
+    size = lines * (76 + eol_size)
+    if rest:
+        size += (rest + 2) // 3 * 4 + eol_size
+    return size
+
+
+def _base64_chunks(chunks, crlf, block_size=BASE64_LINE * 1024):
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= block_size:
+            cut = len(buf) - len(buf) % BASE64_LINE
+            yield base64.encodebytes(buf[:cut]).replace(b"\n", crlf)
+            del buf[:cut]
+    if buf:
+        yield base64.encodebytes(buf).replace(b"\n", crlf)
+
+
+def export_eml(ndb, target, name, nid):
+    streams = {}
+    out, index_data = build_eml(ndb, nid, streams)
+    index_data["link"] = f"{name}.eml"
+    size, chunks = mime_stream(out, streams)
+    target.add(index_data["link"], chunks, size)
 
     return index_data
 
 
-def export_outlook(ndb, ofile, nid):  # noqa:ARG001
-    # TODO: Извеждане като Outlook msg
-    raise NotImplementedError
+def export_outlook(ndb, target, name, nid):
+    size, chunks = build_msg(ndb, nid).chunks()
+    target.add(f"{name}.msg", chunks, size)
+
+
+# [MS-OXMSG] Outlook Item (.msg) File Format
+# https://docs.microsoft.com/en-us/openspecs/exchange_server_protocols/ms-oxmsg
+
+# 2.4.2.2 Multiple-Valued Property Entry; типовете с променлива дължина,
+# за които всяка стойност е в отделен stream
+MSG_MULTIPLE_VARIABLE = (0x101E, 0x101F, 0x1102)
+# типовете с фиксирана дължина, чиито стойности са една след друга в един stream
+MSG_MULTIPLE_FIXED = tuple(0x1000 | x for x in prop_type_sizes if x != 0x000B)
+
+# 2.1.3 Variable Length Properties; размерът включва и терминиращата нула
+MSG_STRING_TERMINATOR = {0x001E: 1, 0x001F: 2}
+
+PROPATTR_READABLE_WRITABLE = 0x00000006
+
+
+def build_msg(ndb, nid):
+    """Съобщението nid като .msg файл в OLEWriter.
+
+    Буферите на атрибутите се копират от pst файла без да се декодират:
+    тези с фиксирана дължина в __properties_version1.0, останалите в
+    __substg1.0_* streams, които се четат от pst файла едва при записа.
+    Таблицата с получателите (TC) не се чете, затова __recip_version1.0
+    липсват; получателите са в DisplayTo и DisplayCc.
+    """
+
+    ole = OLEWriter(MSG_CLSID)
+    msg_named_map(ole.root, ndb.get_prop_names_map())
+
+    attachments = list(ndb.list_nids("ATTACHMENT", nid))
+    # 2.4.1.1 Top Level: Reserved, Next Recipient ID, Next Attachment ID,
+    # Recipient Count, Attachment Count, Reserved
+    header = pack("<8xLLLL8x", 0, len(attachments), 0, len(attachments))
+    msg_properties(ndb, ole.root, PropertyContext(ndb, nid), header)
+
+    for ix, (anid, snid) in enumerate(attachments):
+        storage = ole.root.add_storage(f"__attach_version1.0_#{ix:08X}")
+        msg_properties(ndb, storage, PropertyContext(ndb, anid, snid), bytes(8))
+    return ole
+
+
+def msg_properties(ndb, storage, pc, header):
+    entries = []
+    for ptag, px in sorted(pc._props.items()):
+        ptype = px["propType"]
+        stream_name = f"__substg1.0_{ptag:04X}{ptype:04X}"
+        size, chunks = pc.get_buffer_stream(ptag)
+
+        if 0 < prop_type_sizes.get(ptype, 0) <= 8:
+            # 2.4.2.1 Fixed Length Property Entry
+            value = b"".join(bytes(x) for x in chunks).ljust(8, b"\0")
+        elif ptype == 0x000D:
+            # 2.2.2.1 Embedded Message Object Storage: буферът е NID и размер
+            if not msg_embedded(ndb, storage, pc, b"".join(bytes(x) for x in chunks)):
+                continue
+            value = pack("<LL", 0xFFFFFFFF, 0)
+        elif ptype in MSG_MULTIPLE_VARIABLE:
+            buf = b"".join(bytes(x) for x in chunks)
+            size = msg_multiple(storage, stream_name, ptype, buf)
+            value = pack("<LL", size, 0)
+        elif ptype in MSG_MULTIPLE_FIXED:
+            # В PST стойностите са една след друга ([MS-PST] 2.3.3.4.1), както в msg
+            storage.add_stream(stream_name, (size, chunks))
+            value = pack("<LL", size, 0)
+        else:
+            storage.add_stream(stream_name, (size, chunks))
+            value = pack("<LL", size + MSG_STRING_TERMINATOR.get(ptype, 0), 0)
+        entries.append(pack("<HHL", ptype, ptag, PROPATTR_READABLE_WRITABLE) + value)
+
+    storage.add_stream("__properties_version1.0", header + b"".join(entries))
+
+
+def msg_multiple(storage, stream_name, ptype, buf):
+    """Стойностите от PST формата (брой, отмествания, данни) в отделни streams."""
+
+    count = unpack_from("<L", buf)[0] if buf else 0
+    offsets = list(unpack_from(f"<{count}L", buf, 4)) + [len(buf)]
+    lengths = []
+    for ix in range(count):
+        value = buf[offsets[ix]:offsets[ix+1]]
+        storage.add_stream(f"{stream_name}-{ix:08X}", value)
+        length = len(value) + MSG_STRING_TERMINATOR.get(ptype & 0x0FFF, 0)
+        lengths.append(pack("<L", length) if ptype != 0x1102 else pack("<LL", length, 0))
+    lengths = b"".join(lengths)
+    storage.add_stream(stream_name, lengths)
+    return len(lengths)
+
+
+def msg_embedded(ndb, storage, pc, buf):
+    """Вложеното съобщение като __substg1.0_3701000D; само атрибутите му."""
+
+    if len(buf) < 4:
+        return False
+    sub_nid = unpack_from("<L", buf)[0]
+    try:
+        epc = PropertyContext(ndb, pc._nid, sub_nid)
+    except (KeyError, AssertionError):
+        log.warning("%s", f"{pc._nid}: вложеното съобщение {sub_nid} не може да се прочете")
+        return False
+    sub_storage = storage.add_storage("__substg1.0_3701000D")
+    # 2.4.1.2 Embedded Message Object Storage: както Top Level, без последните 8 байта
+    msg_properties(ndb, sub_storage, epc, pack("<8xLLLL", 0, 0, 0, 0))
+    return True
+
+
+def msg_named_map(storage, names_map):
+    """2.2.3 Named Property Mapping Storage от NAME_TO_ID_MAP на pst файла."""
+
+    storage = storage.add_storage("__nameid_version1.0")
+    guids = names_map.name_streams[0x0002]
+    entries = names_map.name_streams[0x0003]
+    strings = names_map.name_streams[0x0004]
+    storage.add_stream("__substg1.0_00020102", guids)
+    storage.add_stream("__substg1.0_00030102", entries)
+    storage.add_stream("__substg1.0_00040102", strings)
+
+    # 2.2.3.2 Property Name to Property ID Mapping Streams
+    buckets = {}
+    for pos in range(0, len(entries) - 7, 8):
+        name_id, guid_kind, prop_ix = unpack_from("<LHH", entries, pos)
+        if guid_kind & 0x1:
+            name_len = unpack_from("<L", strings, name_id)[0]
+            name_id = ms_crc32(strings[name_id+4:name_id+4+name_len])
+        stream_id = 0x1000 + (name_id ^ guid_kind) % 0x1F
+        buckets.setdefault(stream_id, []).append(pack("<LHH", name_id, guid_kind, prop_ix))
+    for stream_id, bucket in sorted(buckets.items()):
+        storage.add_stream(f"__substg1.0_{stream_id:04X}0102", b"".join(bucket))
+
+
+def ms_crc32(data):
+    """CRC-32 по [MS-OXMSG] 2.2.3.2.2 (начална стойност 0, без крайно XOR)."""
+
+    return zlib.crc32(data, 0xFFFFFFFF) ^ 0xFFFFFFFF
 
 
 if __name__ == "__main__":
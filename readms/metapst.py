@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 # vim:ft=python:et:ts=4:sw=4:ai
 
+import sys
 from pkgutil import get_data
 
 from readms.readutl import UnpackDesc, ulong_from_tuple
@@ -183,6 +184,13 @@ for _line in _prop_types.splitlines():
         prop_types[_numh] = _ptyp, _bytes, " ".join((_desc, _line.strip()))
 del _line, _numh, _ptyp, _bytes, _desc, _prop_types  # pylint: disable=undefined-loop-variable
 
+# [MS-OXCDATA] 2.11.1 Размерите на типовете с фиксирана дължина, включително
+# на тези, които не са описани в prop_types; нужни са за извличане на буфера
+prop_type_sizes = {
+    0x0002: 2, 0x0003: 4, 0x0004: 4, 0x0005: 8, 0x0006: 8, 0x0007: 8,
+    0x000A: 4, 0x000B: 1, 0x0014: 8, 0x0040: 8, 0x0048: 16,
+}
+
 # 2.2.2.6 HEADER
 _HEADER_1 = """\
 dwMagic         byte[4]   # MUST be { 0x21, 0x42, 0x44, 0x4E } ("!BDN")
@@ -524,6 +532,7 @@ def parse_ms_oxprops(_silent=False, _maintain=False):
     # pylint: disable=too-many-statements
     # Колко да е кратко парсването на файла зс докумнетацията на MS и получаване на
     # дефиницията на атрибутите - ID, код име, описание, тип на стойността и други
+    # Отчетът за зареждането е в stderr, за да не се смесва с изхода на командите
 
     def read_events():
         in_range, in_cont = False, False
@@ -594,17 +603,17 @@ def parse_ms_oxprops(_silent=False, _maintain=False):
                 dx = {int(x[id_name], 16): x for x in parsed_prop_types if id_name in x}
                 result.update(dx)
                 if not _silent:
-                    print(f"{len(dx):#5d} hashed by {id_name}")
+                    print(f"{len(dx):#5d} hashed by {id_name}", file=sys.stderr)
             if not _silent:
-                print(info)
-                print(f"{len(parsed_prop_types):#5d} properties found")
+                print(info, file=sys.stderr)
+                print(f"{len(parsed_prop_types):#5d} properties found", file=sys.stderr)
             id_names = ("Property long ID (LID)", "Property ID")
             for id_name in id_names:
                 append_desc(id_name)
             if not _silent:
                 lost = [x["name"] for x in parsed_prop_types
                         if all((z not in x) for z in id_names)]
-                print(f"{len(lost):#5d} lost for no ID defined")
+                print(f"{len(lost):#5d} lost for no ID defined", file=sys.stderr)
 
             # Това се пуска за разследване на повторения на кодовете на таговете
             # Има някои, които не си отговарят добре на името и типа на данните
@@ -0,0 +1,965 @@
+# -*- coding: UTF-8 -*-
+# vim:ft=python:et:ts=4:sw=4:ai
+
+import codecs
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import shutil
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from heapq import nlargest
+from struct import calcsize, pack
+from struct import unpack_from as unpackb
+from tempfile import mkstemp
+
+from pytz import timezone
+from pytz import utc as UTC
+
+from readms.metapst import get_internet_code_page
+from readms.readpst import PropertyContext
+from readms.readutl import html_to_text, rtf_from_compressed, rtf_to_text
+
+log = logging.getLogger(__name__)
+
+
+def message_encoding(pc):
+    ec = pc.get_value_safe("InternetCodepage")
+    code_page = get_internet_code_page(ec) if ec is not None else None
+    return code_page or "UTF-8"
+
+
+def message_body_text(pc):
+    """Текста на съобщението от най-евтиното налично представяне.
+
+    Последователно се проверяват Body, Html и RtfCompressed; за последните
+    две се премахва форматирането.
+    """
+
+    text = pc.get_value_safe("Body")
+    if text is not None:
+        return text
+    html = pc.get_value_safe("Html")
+    if html is not None:
+        return html_to_text(codecs.decode(html.data, message_encoding(pc), "replace"))
+    rtf = pc.get_value_safe("RtfCompressed")
+    if rtf is not None:
+        return rtf_to_text(rtf_from_compressed(rtf.data))
+    return None
+
+
+def iter_messages(ndb):
+    """Съобщенията от NBT като (nid, nidParent)."""
+
+    for nx in ndb._nbt:
+        if nx["typeCode"] == "NORMAL_MESSAGE":
+            yield nx["nid"], nx["nidParent"]
+
+
+def scan_messages(ndb):
+    """Както iter_messages, но по позицията на данните във файла.
+
+    Блоковете на съобщенията се четат предварително на групи (виж
+    NDBLayer.schedule_reads), затова редът не е по nid; индексите, които
+    зависят от реда, подреждат резултата сами.
+    """
+
+    return ndb.schedule_reads(list(iter_messages(ndb)), key=lambda x: x[0])
+
+
+_FILETIME_EPOCH = datetime(year=1601, month=1, day=1, tzinfo=UTC)
+_LOCAL_TZ = timezone("Europe/Sofia")
+
+
+def filetime_from_datetime(dttm):
+    """FILETIME (100ns интервали от 1601-01-01 UTC) за datetime или date.
+
+    За date и datetime без часова зона се приема местното време, както в
+    PropertyValue._read_Time.
+    """
+
+    if not isinstance(dttm, datetime):
+        dttm = datetime(dttm.year, dttm.month, dttm.day)
+    if dttm.tzinfo is None:
+        dttm = _LOCAL_TZ.localize(dttm)
+    delta = dttm - _FILETIME_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10_000_000 + delta.microseconds * 10
+
+
+def datetime_from_filetime(filetime):
+    """datetime за FILETIME, до секунди както в PropertyValue._read_Time."""
+
+    days, seconds = divmod(filetime // 10_000_000, 24*60*60)
+    delta = timedelta(days=days, seconds=seconds)
+    return (_FILETIME_EPOCH + delta).astimezone(_LOCAL_TZ)
+
+
+def get_filetime(pc, prop_name):
+    """Стойността на атрибут от тип Time без преобразуване (FILETIME)."""
+
+    ptag = pc._propx.get(prop_name)
+    if ptag is None:
+        return None
+    return unpackb("<Q", pc.get_buffer(ptag))[0]
+
+
+class NidSpace:
+    """Плътно преномериране на nid на съобщенията (0, 1, 2, ...).
+
+    Поредният номер на съобщението е позицията на nid в подредения масив
+    nids. Върху него се строят NidBitmap. Поредните номера се пазят и в
+    речник, за да не се търси всеки nid с bisect.
+    """
+
+    def __init__(self, nids):
+        self.nids = array("Q", sorted(nids))
+        self._ranks = {nid: pos for pos, nid in enumerate(self.nids)}
+
+    @classmethod
+    def from_ndb(cls, ndb):
+        return cls(nid for nid, _nidp in iter_messages(ndb))
+
+    def __len__(self):
+        return len(self.nids)
+
+    def ordinal(self, nid):
+        return self._ranks.get(nid)
+
+    def bitmap(self, nids=()):
+        """NidBitmap със съобщенията nids; непознатите nid се пропускат."""
+
+        if isinstance(nids, NidBitmap):
+            assert nids.space is self
+            return nids
+        ranks = self._ranks
+        buf = bytearray((len(self.nids) + 7) // 8)
+        for nid in nids:
+            pos = ranks.get(nid)
+            if pos is not None:
+                buf[pos >> 3] |= 1 << (pos & 7)
+        return NidBitmap(self, int.from_bytes(buf, "little"))
+
+    def full(self):
+        return NidBitmap(self, (1 << len(self.nids)) - 1)
+
+
+class NidBitmap:
+    """Множество от съобщения като bitmap върху NidSpace.
+
+    Битовете се пазят в едно цяло число, така че AND (&), OR (|), ANDNOT (-)
+    и броя (len) са операции върху цели числа, изпълнявани изцяло в C.
+    Проверката с in е O(размер) и не бива да се използва в цикъл - за
+    обхождане е предвиден __iter__, който връща nid в нарастващ ред.
+    """
+
+    __slots__ = ("bits", "space")
+
+    def __init__(self, space, bits=0):
+        self.space = space
+        self.bits = bits
+
+    def _check(self, other):
+        assert other.space is self.space, "bitmap от различни NidSpace"
+
+    def __and__(self, other):
+        self._check(other)
+        return NidBitmap(self.space, self.bits & other.bits)
+
+    def __or__(self, other):
+        self._check(other)
+        return NidBitmap(self.space, self.bits | other.bits)
+
+    def __sub__(self, other):
+        self._check(other)
+        return NidBitmap(self.space, self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, NidBitmap) and other.space is self.space \
+            and other.bits == self.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, nid):
+        pos = self.space.ordinal(nid)
+        return pos is not None and (self.bits >> pos) & 1 == 1
+
+    def __iter__(self):
+        nids = self.space.nids
+        buf = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little")
+        for byte_pos, byte in enumerate(buf):
+            while byte:
+                low = byte & -byte
+                yield nids[(byte_pos << 3) + low.bit_length() - 1]
+                byte ^= low
+
+
+def is_uptodate_index(ifile, idx_fnm):
+    """Индексът съществува и не е по-стар от pst файла."""
+
+    if not os.path.exists(idx_fnm):
+        return False
+    fn_mtime = datetime.fromtimestamp(os.stat(ifile).st_mtime)
+    ix_mtime = datetime.fromtimestamp(os.stat(idx_fnm).st_mtime)
+    return fn_mtime <= ix_mtime
+
+
+def open_message_index(index_class, ndb, ifile, index_dir, suffix):
+    """Зарежда индекса <name>_<suffix>.idx или го създава, ако не е актуален."""
+
+    name, _ex = os.path.splitext(os.path.basename(ifile))
+    index_fnm = os.path.join(index_dir, f"{name}_{suffix}.idx")
+    index = index_class()
+    if not is_uptodate_index(ifile, index_fnm):
+        start_ = time.time()
+        log.info("create %s index", suffix)
+        index.create(ndb)
+        index.save(index_fnm)
+        log.info(f"done in {(time.time()-start_):>,.3f} sec")
+    else:
+        index.read(index_fnm)
+    return index
+
+
+class MessageIndex:
+    """Индекс по съобщенията на pst файл, съхраняван с pickle.
+
+    Наследниците описват в _persist атрибутите, които се записват, и
+    реализират create(ndb), който ги попълва с едно обхождане на съобщенията.
+    """
+
+    _persist = ()
+
+    def create(self, ndb):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def save(self, file_name):
+        with open(file_name, "wb") as fout:
+            state = {name: getattr(self, name) for name in self._persist}
+            pickle.dump(state, fout, pickle.HIGHEST_PROTOCOL)
+
+    def read(self, file_name):
+        with open(file_name, "rb") as fin:
+            state = pickle.load(fin)
+        for name in self._persist:
+            setattr(self, name, state[name])
+
+
+class SortColumnsIndex(MessageIndex):
+    """Подредба на съобщенията във всяка папка по най-често използваните полета.
+
+    За всяка папка и поле се пази array с nid на съобщенията, подредени по
+    нарастване на стойността (съобщенията без стойност са накрая).
+    """
+
+    KEYS = ("MessageDeliveryTime", "MessageSizeExtended", "Subject", "SenderName")
+    _persist = ("columns",)
+
+    def __init__(self):
+        self.columns = {}
+
+    def create(self, ndb):
+        values = {}
+        for nid, nidp in scan_messages(ndb):
+            pc = PropertyContext(ndb, nid)
+            folder = values.setdefault(nidp, {key: [] for key in self.KEYS})
+            for key in self.KEYS:
+                folder[key].append((pc.get_value_safe(key), nid))
+
+        self.columns = {}
+        for nidp, folder in values.items():
+            self.columns[nidp] = {}
+            for key, column in folder.items():
+                column.sort(key=lambda x: (x[0] is None, x[0], x[1]))
+                self.columns[nidp][key] = array("Q", [nid for _, nid in column])
+
+    def has_key(self, order_by):
+        return order_by in self.KEYS
+
+    def get_column(self, folder, order_by):
+        folder = self.columns.get(folder)
+        if folder is None:
+            return array("Q")
+        return folder[order_by]
+
+
+class DateIndex(MessageIndex):
+    """Индекс по MessageDeliveryTime за търсене по период и времева линия.
+
+    Пазят се подредени паралелни масиви с FILETIME и nid за всички
+    съобщения и отделно за всяка папка. Съобщенията без дата не се индексират.
+    """
+
+    _persist = ("times", "nids", "folders")
+
+    def __init__(self, prop_name="MessageDeliveryTime"):
+        self._prop_name = prop_name
+        self.times = array("Q")
+        self.nids = array("Q")
+        self.folders = {}
+
+    def create(self, ndb):
+        entries = []
+        for nid, nidp in scan_messages(ndb):
+            filetime = get_filetime(PropertyContext(ndb, nid), self._prop_name)
+            if filetime is not None:
+                entries.append((filetime, nid, nidp))
+        entries.sort()
+        self.times = array("Q", [x[0] for x in entries])
+        self.nids = array("Q", [x[1] for x in entries])
+
+        folders = {}
+        for filetime, nid, nidp in entries:
+            times, nids = folders.setdefault(nidp, ([], []))
+            times.append(filetime)
+            nids.append(nid)
+        self.folders = {nidp: (array("Q", times), array("Q", nids))
+                        for nidp, (times, nids) in folders.items()}
+
+    def _arrays(self, folder=None):
+        if folder is None:
+            return self.times, self.nids
+        return self.folders.get(folder, (array("Q"), array("Q")))
+
+    @staticmethod
+    def _bounds(times, start, end):
+        lo = 0 if start is None else bisect_left(times, filetime_from_datetime(start))
+        hi = len(times) if end is None else bisect_left(times, filetime_from_datetime(end))
+        return lo, hi
+
+    def range(self, start=None, end=None, folder=None):
+        """nid на съобщенията със start <= дата < end (в хронологичен ред)."""
+
+        times, nids = self._arrays(folder)
+        lo, hi = self._bounds(times, start, end)
+        return nids[lo:hi]
+
+    def count(self, start=None, end=None, folder=None):
+        times, _nids = self._arrays(folder)
+        lo, hi = self._bounds(times, start, end)
+        return hi - lo
+
+    @staticmethod
+    def _next_period(day, period):
+        if period == "day":
+            return day + timedelta(days=1)
+        if period == "week":
+            return day + timedelta(days=7)
+        if period == "month":
+            return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+        raise KeyError(period)
+
+    @staticmethod
+    def _period_start(day, period):
+        if period == "week":
+            return day - timedelta(days=day.weekday())
+        if period == "month":
+            return day.replace(day=1)
+        return day
+
+    def histogram(self, period="month", folder=None):
+        """Брой съобщения по ден, седмица (от понеделник) или месец.
+
+        Резултатът е списък (начало на периода, брой) без празните периоди.
+        Всеки период се брои с bisect, така че не се обхождат всички дати.
+        """
+
+        times, _nids = self._arrays(folder)
+        if len(times) == 0:
+            return []
+        day = self._period_start(datetime_from_filetime(times[0]).date(), period)
+        last = datetime_from_filetime(times[-1]).date()
+        result = []
+        lo = 0
+        while day <= last:
+            next_day = self._next_period(day, period)
+            hi = bisect_left(times, filetime_from_datetime(next_day), lo)
+            if hi > lo:
+                result.append((day, hi - lo))
+            day, lo = next_day, hi
+        return result
+
+
+class AddressIndex(MessageIndex):
+    """Индекс по подател и получатели на съобщенията.
+
+    За всяка роля (from, to, cc) се пази речник нормализиран адрес към array
+    с nid, името за показване на всеки адрес и подреден списък с двойки
+    (адрес или име, адрес) за търсене по префикс. Подателят е с SMTP адреса
+    си, а името е само етикет, така че всеки кореспондент се брои веднъж.
+    За получателите в PC има само DisplayTo и DisplayCc (имената, разделени
+    с ;), тъй като таблицата с получателите (TC) все още не се чете, и там
+    ключ е името.
+    """
+
+    ROLES = ("from", "to", "cc")
+    _persist = ("postings", "labels", "keys")
+
+    def __init__(self):
+        self.postings = {role: {} for role in self.ROLES}
+        self.labels = {role: {} for role in self.ROLES}
+        self.keys = {role: [] for role in self.ROLES}
+
+    @staticmethod
+    def normalize(value):
+        value = value.strip().strip("'\"<>").strip()
+        return " ".join(value.lower().split())
+
+    @staticmethod
+    def _sender(pc):
+        """(адрес, име) на подателя; адресът е None, ако няма SMTP адрес."""
+
+        address = None
+        for name in ("SenderSmtpAddress", "SentRepresentingSmtpAddress",
+                     "SenderEmailAddress", "SentRepresentingEmailAddress"):
+            value = pc.get_value_safe(name)
+            # SenderEmailAddress може да е X500 адрес от Exchange
+            if value is not None and "@" in value:
+                address = value
+                break
+        label = pc.get_value_safe("SenderName")
+        if label is None or len(label.strip()) == 0:
+            label = pc.get_value_safe("SentRepresentingName")
+        return [(address, label)]
+
+    @staticmethod
+    def _display_names(pc, prop_name):
+        value = pc.get_value_safe(prop_name)
+        if value is None:
+            return []
+        return [(None, name) for name in value.split(";")]
+
+    def create(self, ndb):
+        postings = {role: {} for role in self.ROLES}
+        labels = {role: {} for role in self.ROLES}
+        keys = {role: set() for role in self.ROLES}
+        for nid, _nidp in scan_messages(ndb):
+            pc = PropertyContext(ndb, nid)
+            role_entries = (("from", self._sender(pc)),
+                            ("to", self._display_names(pc, "DisplayTo")),
+                            ("cc", self._display_names(pc, "DisplayCc")))
+            for role, entries in role_entries:
+                for address, label in entries:
+                    key = self.normalize(address or label or "")
+                    if len(key) == 0:
+                        continue
+                    nids = postings[role].setdefault(key, [])
+                    if len(nids) == 0 or nids[-1] != nid:
+                        nids.append(nid)
+                    keys[role].add((key, key))
+                    if label is not None and len(label.strip()) > 0:
+                        labels[role].setdefault(key, " ".join(label.split()))
+                        keys[role].add((self.normalize(label), key))
+
+        self.postings = {role: {key: array("Q", sorted(nids))
+                                for key, nids in role_postings.items()}
+                         for role, role_postings in postings.items()}
+        self.labels = labels
+        self.keys = {role: sorted(role_keys) for role, role_keys in keys.items()}
+
+    def _prefix_keys(self, role, prefix):
+        """Адресите, при които адресът или името започва с prefix."""
+
+        keys = self.keys[role]
+        prefix = self.normalize(prefix)
+        lo = bisect_left(keys, (prefix,))
+        # всички ключове, започващи с prefix, са преди prefix + максималния символ
+        hi = bisect_right(keys, (prefix + "\U0010FFFF",), lo)
+        return {key for _, key in keys[lo:hi]}
+
+    def lookup(self, prefix, roles=None):
+        """nid на съобщенията с адрес или име, започващ с prefix."""
+
+        result = set()
+        for role in roles or self.ROLES:
+            for key in self._prefix_keys(role, prefix):
+                result.update(self.postings[role][key])
+        return result
+
+    def correspondents(self, role, prefix="", limit=None):
+        """Списък (адрес, име, брой съобщения), подреден по брой намаляващо."""
+
+        labels = self.labels[role]
+        result = [(key, labels.get(key, key), len(self.postings[role][key]))
+                  for key in self._prefix_keys(role, prefix)]
+        result.sort(key=lambda x: (-x[2], x[0]))
+        return result[:limit] if limit is not None else result
+
+
+class ThreadIndex(MessageIndex):
+    """Индекс на нишките (conversations) от ConversationIndex.
+
+    ConversationIndex ([MS-OXOMSG] 2.2.1.3) съдържа 22 байта header, общ за
+    цялата нишка, и по 5 байта за всеки следващ отговор. Родител е
+    съобщението, чийто ConversationIndex е същия без последните 5 байта.
+    Съобщенията без ConversationIndex се добавят към нишка по
+    ConversationTopic.
+
+    Всичко се пази в масиви: nids (подредени) и успоредните им thread_ids
+    и parents, както и members - nid на съобщенията във всяка нишка.
+    """
+
+    _persist = ("nids", "thread_ids", "parents", "members")
+    HEADER_SIZE = 22
+    CHILD_SIZE = 5
+
+    def __init__(self):
+        self.nids = array("Q")
+        self.thread_ids = array("L")
+        self.parents = array("Q")
+        self.members = []
+
+    @staticmethod
+    def _topic_key(pc):
+        topic = pc.get_value_safe("ConversationTopic")
+        if topic is None:
+            return None
+        return hashlib.md5(topic.encode("UTF-8")).hexdigest()
+
+    def _parent_nid(self, conv_index, by_index):
+        # родителят може да липсва в pst файла, тогава се търси по-горе
+        while len(conv_index) > self.HEADER_SIZE:
+            conv_index = conv_index[:-self.CHILD_SIZE]
+            nid = by_index.get(conv_index)
+            if nid is not None:
+                return nid
+        return 0
+
+    def create(self, ndb):
+        entries = []
+        by_index, by_topic = {}, {}
+        for nid, _nidp in scan_messages(ndb):
+            pc = PropertyContext(ndb, nid)
+            conv_index = pc.get_value_safe("ConversationIndex")
+            conv_index = bytes(conv_index.data) if conv_index is not None else None
+            if conv_index is not None and len(conv_index) < self.HEADER_SIZE:
+                conv_index = None
+            entries.append((nid, conv_index, self._topic_key(pc)))
+
+        # при еднакъв ConversationIndex или тема първото е с най-малък nid
+        entries.sort(key=lambda x: x[0])
+        for nid, conv_index, topic in entries:
+            if conv_index is not None:
+                by_index.setdefault(conv_index, nid)
+                if topic is not None:
+                    by_topic.setdefault(topic, conv_index[:self.HEADER_SIZE])
+
+        threads = {}
+        rows = []
+        for nid, conv_index, topic in entries:
+            if conv_index is not None:
+                thread_key = conv_index[:self.HEADER_SIZE]
+                parent = self._parent_nid(conv_index, by_index)
+            elif topic is not None:
+                thread_key = by_topic.get(topic, topic)
+                parent = 0
+            else:
+                continue
+            thread_id = threads.setdefault(thread_key, len(threads))
+            rows.append((nid, thread_id, parent, conv_index or b""))
+
+        members = [[] for _ in range(len(threads))]
+        for nid, thread_id, _parent, conv_index in sorted(rows, key=lambda x: x[3]):
+            members[thread_id].append(nid)
+        rows.sort()
+        self.nids = array("Q", [x[0] for x in rows])
+        self.thread_ids = array("L", [x[1] for x in rows])
+        self.parents = array("Q", [x[2] for x in rows])
+        self.members = [array("Q", x) for x in members]
+
+    def _position(self, nid):
+        pos = bisect_left(self.nids, nid)
+        if pos < len(self.nids) and self.nids[pos] == nid:
+            return pos
+        return None
+
+    def thread(self, nid):
+        """nid на всички съобщения в нишката на nid, подредени по ConversationIndex."""
+
+        pos = self._position(nid)
+        if pos is None:
+            return array("Q")
+        return self.members[self.thread_ids[pos]]
+
+    def parent(self, nid):
+        pos = self._position(nid)
+        if pos is None or self.parents[pos] == 0:
+            return None
+        return self.parents[pos]
+
+    def children(self, nid):
+        return [x for x in self.thread(nid) if self.parent(x) == nid]
+
+
+class CategoryIndex(MessageIndex):
+    """Фасетен индекс по категориите (Keywords) на съобщенията.
+
+    За всяка категория се пазят nid на съобщенията (array) и броя им по папки.
+    """
+
+    _persist = ("postings", "folder_counts")
+
+    def __init__(self):
+        self.postings = {}
+        self.folder_counts = {}
+
+    def create(self, ndb):
+        postings, folder_counts = {}, {}
+        for nid, nidp in scan_messages(ndb):
+            keywords = PropertyContext(ndb, nid).get_value_safe("Keywords")
+            if keywords is None:
+                continue
+            if isinstance(keywords, str):
+                keywords = [keywords]
+            for category in set(keywords):
+                postings.setdefault(category, []).append(nid)
+                counts = folder_counts.setdefault(category, {})
+                counts[nidp] = counts.get(nidp, 0) + 1
+        self.postings = {category: array("Q", sorted(nids))
+                         for category, nids in postings.items()}
+        self.folder_counts = folder_counts
+
+    def categories(self, folder=None):
+        """Списък (категория, брой съобщения), подреден по име."""
+
+        result = []
+        for category in sorted(self.postings):
+            if folder is None:
+                count = len(self.postings[category])
+            else:
+                count = self.folder_counts[category].get(folder, 0)
+            if count > 0:
+                result.append((category, count))
+        return result
+
+    def lookup(self, category=None):
+        """nid на съобщенията с категорията или с коя да е категория при None."""
+
+        if category is not None:
+            return set(self.postings.get(category, ()))
+        result = set()
+        for nids in self.postings.values():
+            result.update(nids)
+        return result
+
+
+class RowCacheIndex(MessageIndex):
+    """Полетата за списъците със съобщения и кратък откъс от текста.
+
+    Файлът се чете през mmap и има вида:
+        header  - MAGIC, VERSION
+        records - pickle на tuple със стойностите на FIELDS и откъса
+        nids    - подредени nid (Q)
+        starts  - начало на записа за всеки nid (Q)
+        ends    - край на записа за всеки nid (Q)
+        fields  - pickle на FIELDS
+        footer  - позиция на nids, брой записи, позиция на fields (QQQ)
+    Стойностите от тип datetime се записват като FILETIME (без часова зона).
+    """
+
+    MAGIC = b"RMRC"
+    VERSION = 1
+    FIELDS = ("MessageDeliveryTime", "MessageSizeExtended", "Subject", "SenderName",
+              "DisplayTo", "DisplayCc", "ConversationTopic", "Importance", "MessageFlags")
+    SNIPPET_SIZE = 200
+    _header_fmt = "<4sL"
+    _footer_fmt = "<QQQ"
+
+    def __init__(self):
+        self._fields = self.FIELDS
+        self._tmp = None
+        self._entries = None
+        self._map = None
+        self._nids = None
+        self._starts = None
+        self._ends = None
+
+    @classmethod
+    def make_snippet(cls, text):
+        if text is None:
+            return None
+        return " ".join(text[:cls.SNIPPET_SIZE * 4].split())[:cls.SNIPPET_SIZE]
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, datetime):
+            return ("T", filetime_from_datetime(value))
+        return value
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value, tuple) and len(value) == 2 and value[0] == "T":
+            return datetime_from_filetime(value[1])
+        return value
+
+    def create(self, ndb):
+        # записите се пишат във временен файл, който save допълва и премества
+        fd, self._tmp = mkstemp(suffix=".rows")
+        self._entries = []
+        try:
+            with os.fdopen(fd, "wb") as ftmp:
+                pos = calcsize(self._header_fmt)
+                ftmp.write(pack(self._header_fmt, self.MAGIC, self.VERSION))
+                for nid, _nidp in scan_messages(ndb):
+                    pc = PropertyContext(ndb, nid)
+                    values = [self._encode(pc.get_value_safe(name)) for name in self._fields]
+                    values.append(self.make_snippet(message_body_text(pc)))
+                    record = pickle.dumps(tuple(values), pickle.HIGHEST_PROTOCOL)
+                    ftmp.write(record)
+                    self._entries.append((nid, pos, len(record)))
+                    pos += len(record)
+        except BaseException:
+            os.remove(self._tmp)
+            self._tmp = None
+            raise
+
+    def save(self, file_name):
+        self._entries.sort()
+        with open(self._tmp, "ab") as ftmp:
+            dir_pos = ftmp.tell()
+            ftmp.write(array("Q", [x[0] for x in self._entries]).tobytes())
+            ftmp.write(array("Q", [x[1] for x in self._entries]).tobytes())
+            ftmp.write(array("Q", [x[1] + x[2] for x in self._entries]).tobytes())
+            fields_pos = ftmp.tell()
+            ftmp.write(pickle.dumps(self._fields, pickle.HIGHEST_PROTOCOL))
+            ftmp.write(pack(self._footer_fmt, dir_pos, len(self._entries), fields_pos))
+        shutil.move(self._tmp, file_name)
+        self._tmp = None
+        self.read(file_name)
+
+    def read(self, file_name):
+        self.close()
+        # mmap пази собствен дескриптор, така че файлът може да се затвори веднага
+        with open(file_name, "rb") as fin:
+            self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = unpackb(self._header_fmt, self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f"{file_name}: невалиден формат {magic}/{version}")
+        footer_size = calcsize(self._footer_fmt)
+        dir_pos, count, fields_pos = unpackb(
+            self._footer_fmt, self._map, len(self._map) - footer_size)
+        view = memoryview(self._map)
+        self._nids = view[dir_pos:dir_pos + 8 * count].cast("Q")
+        self._starts = view[dir_pos + 8 * count:dir_pos + 16 * count].cast("Q")
+        self._ends = view[dir_pos + 16 * count:dir_pos + 24 * count].cast("Q")
+        self._fields = pickle.loads(self._map[fields_pos:len(self._map) - footer_size])
+
+    def close(self):
+        for view in (self._nids, self._starts, self._ends):
+            if view is not None:
+                view.release()
+        self._nids = self._starts = self._ends = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def has_fields(self, fields):
+        return all(x in self._fields for x in fields)
+
+    def _record(self, nid):
+        pos = bisect_left(self._nids, nid)
+        if pos == len(self._nids) or self._nids[pos] != nid:
+            return None
+        return pickle.loads(self._map[self._starts[pos]:self._ends[pos]])
+
+    def get_row(self, nid, fields):
+        """Стойностите на fields за съобщението или None, ако липсва в индекса."""
+
+        record = self._record(nid)
+        if record is None:
+            return None
+        return [self._decode(record[self._fields.index(x)]) for x in fields]
+
+    def get_snippet(self, nid):
+        record = self._record(nid)
+        return record[-1] if record is not None else None
+
+
+AttachmentInfo = namedtuple("AttachmentInfo", ["nid", "anid", "name", "size", "mime", "cid"])
+
+
+class AttachmentIndex(MessageIndex):
+    """Обобщена информация за приложените файлове.
+
+    За всяко приложение се пазят nid на съобщението, hnid на приложението,
+    име, размер, AttachMimeTag и AttachContentId, подредени по nid (масиви
+    за числата и списъци за текстовете). Броят и общият размер по съобщения
+    се пазят в отделни успоредни масиви.
+    """
+
+    _persist = ("nids", "anids", "sizes", "names", "mimes", "cids",
+                "msg_nids", "msg_counts", "msg_sizes")
+
+    def __init__(self):
+        self.nids, self.anids, self.sizes = array("Q"), array("Q"), array("Q")
+        self.names, self.mimes, self.cids = [], [], []
+        self.msg_nids, self.msg_counts, self.msg_sizes = array("Q"), array("L"), array("Q")
+
+    @staticmethod
+    def read_attachment(pa):
+        att_name = pa.alt_name("AttachLongFilename", "DisplayName", "AttachFilename")
+        name = pa.get_value(att_name) if att_name is not None else None
+        return (name, pa.get_value_safe("AttachSize", 0) or 0,
+                pa.get_value_safe("AttachMimeTag"), pa.get_value_safe("AttachContentId"))
+
+    def create(self, ndb):
+        rows = []
+        for nid, _nidp in scan_messages(ndb):
+            for _nid, anid in ndb.list_nids("ATTACHMENT", nid):
+                pa = PropertyContext(ndb, nid, anid)
+                rows.append((nid, anid, *self.read_attachment(pa)))
+        rows.sort(key=lambda x: (x[0], x[1]))
+
+        self.nids = array("Q", [x[0] for x in rows])
+        self.anids = array("Q", [x[1] for x in rows])
+        self.names = [x[2] for x in rows]
+        self.sizes = array("Q", [x[3] for x in rows])
+        self.mimes = [x[4] for x in rows]
+        self.cids = [x[5] for x in rows]
+
+        msg_nids, msg_counts, msg_sizes = [], [], []
+        for nid, size in zip(self.nids, self.sizes):
+            if msg_nids and msg_nids[-1] == nid:
+                msg_counts[-1] += 1
+                msg_sizes[-1] += size
+            else:
+                msg_nids.append(nid)
+                msg_counts.append(1)
+                msg_sizes.append(size)
+        self.msg_nids = array("Q", msg_nids)
+        self.msg_counts = array("L", msg_counts)
+        self.msg_sizes = array("Q", msg_sizes)
+
+    def _info(self, pos):
+        return AttachmentInfo(self.nids[pos], self.anids[pos], self.names[pos],
+                              self.sizes[pos], self.mimes[pos], self.cids[pos])
+
+    def summary(self, nid):
+        """(брой, общ размер) на приложенията към съобщението."""
+
+        pos = bisect_left(self.msg_nids, nid)
+        if pos < len(self.msg_nids) and self.msg_nids[pos] == nid:
+            return self.msg_counts[pos], self.msg_sizes[pos]
+        return 0, 0
+
+    def has_attachments(self, nid):
+        return self.summary(nid)[0] > 0
+
+    def attachments(self, nid):
+        lo = bisect_left(self.nids, nid)
+        hi = bisect_right(self.nids, nid, lo)
+        return [self._info(pos) for pos in range(lo, hi)]
+
+    def message_nids(self):
+        return self.msg_nids
+
+    @staticmethod
+    def extension(name):
+        if name is None:
+            return ""
+        return os.path.splitext(name)[1].lower().lstrip(".")
+
+    def _positions(self, extension=None):
+        if extension is None:
+            return range(len(self.nids))
+        extension = extension.lower().lstrip(".")
+        return (pos for pos, name in enumerate(self.names)
+                if self.extension(name) == extension)
+
+    def top_by_size(self, k=10, extension=None):
+        """Най-големите k приложения (по избор само с дадено разширение)."""
+
+        positions = nlargest(k, self._positions(extension), key=self.sizes.__getitem__)
+        return [self._info(pos) for pos in positions]
+
+    def by_extension(self, extension):
+        return [self._info(pos) for pos in self._positions(extension)]
+
+    def extensions(self):
+        """Списък (разширение, брой, общ размер), подреден по общ размер."""
+
+        stats = {}
+        for name, size in zip(self.names, self.sizes):
+            entry = stats.setdefault(self.extension(name), [0, 0])
+            entry[0] += 1
+            entry[1] += size
+        result = [(ext, cnt, size) for ext, (cnt, size) in stats.items()]
+        result.sort(key=lambda x: -x[2])
+        return result
+
+
+class SizeIndex(MessageIndex):
+    """Точните размери на съобщенията и папките по BBT (виж NDBLayer.nid_size_exact).
+
+    Размерът на папка е сумата от размерите на съобщенията в нея и на
+    самата папка (PC). Справките за най-големите k са с heap - O(n log k).
+    """
+
+    _persist = ("nids", "parents", "sizes", "folders")
+    # горните граници на интервалите за разпределението по размер
+    BUCKETS = (10 * 2**10, 100 * 2**10, 2**20, 10 * 2**20, 100 * 2**20)
+
+    def __init__(self):
+        self.nids, self.parents, self.sizes = array("Q"), array("Q"), array("Q")
+        self.folders = {}
+
+    def create(self, ndb):
+        # nid_size_exact чете data trees, затова съобщенията са по реда във файла
+        rows = sorted((nid, nidp, ndb.nid_size_exact(nid)) for nid, nidp in scan_messages(ndb))
+        self.nids = array("Q", [x[0] for x in rows])
+        self.parents = array("Q", [x[1] for x in rows])
+        self.sizes = array("Q", [x[2] for x in rows])
+
+        self.folders = {}
+        folders = [nx["nid"] for nx in ndb._nbt if nx["typeCode"] == "NORMAL_FOLDER"]
+        for nid in ndb.schedule_reads(folders):
+            self.folders[nid] = [0, ndb.nid_size_exact(nid)]
+        for _nid, nidp, size in rows:
+            folder = self.folders.setdefault(nidp, [0, 0])
+            folder[0] += 1
+            folder[1] += size
+
+    def total_size(self):
+        return sum(size for _cnt, size in self.folders.values())
+
+    def top_messages(self, k=10, folder=None):
+        """Списък (nid, nidParent, размер) на най-големите k съобщения."""
+
+        positions = range(len(self.nids))
+        if folder is not None:
+            positions = (pos for pos in positions if self.parents[pos] == folder)
+        positions = nlargest(k, positions, key=self.sizes.__getitem__)
+        return [(self.nids[pos], self.parents[pos], self.sizes[pos]) for pos in positions]
+
+    def top_folders(self, k=10):
+        """Списък (nid, брой съобщения, размер) на най-големите k папки."""
+
+        top = nlargest(k, self.folders.items(), key=lambda x: x[1][1])
+        return [(nid, cnt, size) for nid, (cnt, size) in top]
+
+    def distribution(self, folder=None):
+        """Брой и размер на съобщенията по интервали BUCKETS (и над последния)."""
+
+        result = [[limit, 0, 0] for limit in (*self.BUCKETS, None)]
+        for nidp, size in zip(self.parents, self.sizes):
+            if folder is not None and nidp != folder:
+                continue
+            entry = result[bisect_left(self.BUCKETS, size)]
+            entry[1] += 1
+            entry[2] += size
+        return [tuple(x) for x in result]
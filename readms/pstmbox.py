@@ -8,12 +8,38 @@ import logging
 import os
 import pickle
 import re
+import shutil
+import sqlite3
+import threading
+from bisect import bisect_left, bisect_right
 from codecs import open as open_enc
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
+from functools import lru_cache
+from heapq import merge as heap_merge
+from itertools import groupby
 from pkgutil import get_data
 from string import whitespace
+from tempfile import mkdtemp
 from time import time
-
+from types import MappingProxyType
+
+from readms.pstindex import (
+    AddressIndex,
+    AttachmentIndex,
+    CategoryIndex,
+    DateIndex,
+    NidSpace,
+    RowCacheIndex,
+    SizeIndex,
+    SortColumnsIndex,
+    ThreadIndex,
+    is_uptodate_index,
+    message_body_text,
+    open_message_index,
+)
 from readms.readpst import NDBLayer, PropertyContext
 
 log = logging.getLogger(__name__)
@@ -24,17 +50,24 @@ log = logging.getLogger(__name__)
 class MboxCacheEntry:
     """Прочетен архив с поща."""
 
-    def __init__(self, ifile, index_dir):
+    def __init__(self, ifile, index_dir, index_jobs=1, search_backend="pickle"):
         self._ifile = ifile
         self._index_dir = index_dir
+        self._index_jobs = index_jobs
+        self._search_backend = search_backend
         self._since = None
         self._mbox = None
         self._topic = None
         self._search_index = None
         self._search_match_nids = None
+        self._nid_space = None
+        self._query_cache = QueryCache()
+        self._filter_eval = FilterEvaluator(self)
         self._sorted_nid = {}
         self._folders = []
         self._message = []
+        self._message_counts = {}
+        self._indexes = {}
         self.update(_force=True)
         self.tags_list = TagsList(self._index_dir)
         self._load_tags()
@@ -49,6 +82,10 @@ class MboxCacheEntry:
         if _force:
             log.info("load NDBLayer from %s", self._ifile)
             self._mbox = NDBLayer(self._ifile, self._index_dir)
+            self._nid_space = NidSpace.from_ndb(self._mbox)
+            self._search_match_nids = None
+            self._invalidate_results()
+            self._close_indexes()
             self._index_content()
             # pylint: disable=protected-access
             # тук е само за logging
@@ -58,42 +95,95 @@ class MboxCacheEntry:
         self._since = datetime.now()
 
     def _index_pc(self, pc_type, use_filter=False):
+        if use_filter and self._search_match_nids is not None:
+            # само намерените съобщения, без обхождане на целия NBT
+            nbtx = self._mbox._nbtx
+            return [(nid, nbtx[nid]["nidParent"]) for nid in self._search_match_nids]
         pc_list = []
         for nx in self._mbox._nbt:
             if nx["typeCode"] != pc_type:
                 continue
-            with_filter = use_filter and self._search_match_nids is not None
-            if with_filter and nx["nid"] in self._search_match_nids or not with_filter:
-                pc_list.append((nx["nid"], nx["nidParent"]))
+            pc_list.append((nx["nid"], nx["nidParent"]))
         return pc_list
 
+    def to_bitmap(self, nids):
+        """NidBitmap от nid на съобщения (set, list, array или NidBitmap)."""
+
+        return self._nid_space.bitmap(nids)
+
+    def _invalidate_results(self):
+        self._query_cache.clear()
+        self._filter_eval.clear()
+
+    def _apply_match(self, nids):
+        self._search_match_nids = None if nids is None else self.to_bitmap(nids)
+        self._index_content()
+        return {'nid': self._message[0][1]} if len(self._message) > 0 else None
+
     def _index_content(self):
         self._folders = self._index_pc("NORMAL_FOLDER")
         self._message = self._index_pc("NORMAL_MESSAGE", use_filter=True)
+        self._message_counts = {}
+        for _nid, nidp in self._message:
+            self._message_counts[nidp] = self._message_counts.get(nidp, 0) + 1
         self._sorted_nid = {}
 
-    def _is_uptodate_index(self, idx_fnm):
-        if not os.path.exists(idx_fnm):
-            return False
-        fn_mtime = os.stat(self._ifile).st_mtime
-        fn_mtime = datetime.fromtimestamp(fn_mtime)
-        ix_mtime = os.stat(idx_fnm).st_mtime
-        ix_mtime = datetime.fromtimestamp(ix_mtime)
-        return fn_mtime <= ix_mtime
+    def _message_index(self, index_class, suffix):
+        """Зарежда (или създава, ако не е актуален) индекс от pstindex."""
+
+        index = self._indexes.get(suffix)
+        if index is None:
+            index = open_message_index(
+                index_class, self._mbox, self._ifile, self._index_dir, suffix)
+            self._indexes[suffix] = index
+        return index
+
+    def get_sort_columns(self):
+        return self._message_index(SortColumnsIndex, "sort")
+
+    def get_row_cache(self):
+        return self._message_index(RowCacheIndex, "rows")
+
+    def get_snippet(self, nid):
+        """Кратък откъс от текста на съобщението (от индекса, без четене на PC)."""
+
+        return self.get_row_cache().get_snippet(nid)
+
+    def get_attachment_index(self):
+        return self._message_index(AttachmentIndex, "attachments")
+
+    def get_size_index(self):
+        return self._message_index(SizeIndex, "sizes")
+
+    def get_date_index(self):
+        return self._message_index(DateIndex, "dates")
+
+    def get_address_index(self):
+        return self._message_index(AddressIndex, "addresses")
+
+    def get_thread_index(self):
+        return self._message_index(ThreadIndex, "threads")
+
+    def get_category_index(self):
+        return self._message_index(CategoryIndex, "category_facets")
 
     def get_mbox(self):
         return self._mbox
 
+    def _close_indexes(self):
+        for index in self._indexes.values():
+            index.close()
+        self._indexes = {}
+
     def close(self):
+        self._close_indexes()
+        if self._search_index is not None:
+            self._search_index.close()
         if self._mbox is not None:
             self._mbox.close()
 
     def count_messages(self, folder):
-        result = 0
-        for _nid, nidp in self._message:
-            if nidp == folder:
-                result += 1
-        return result
+        return self._message_counts.get(folder, 0)
 
     def list_messages(self, folder, fields, skip=0, page=20, order_by=None, order_reverse=True):
         """Връща списъка със съобщения, които са в избраната папка.
@@ -103,30 +193,55 @@ class MboxCacheEntry:
         същата последователност.
         """
 
-        order_by = order_by if order_by is not None else 'MessageDeliveryTime'
-        cache_key = folder, order_by, order_reverse
-        nid_list = self._sorted_nid.get(cache_key)
-        if nid_list is None:
-            nid_list = []
-            for nid, nidp in self._message:
-                if nidp != folder:
-                    continue
-                pc = PropertyContext(self._mbox, nid)
-                dttm = pc.get_value(order_by)
-                nid_list.append((nid, dttm))
+        _keys, nid_list = self._sorted_nids(folder, order_by)
+        end = skip + page if page > 0 else len(nid_list)
+        return self._message_rows(
+            self._page_slice(nid_list, skip, end, order_reverse), fields)
+
+    def list_messages_after(self, folder, fields, cursor=None, page=20,
+                            order_by=None, order_reverse=True):
+        """Като list_messages, но страниците се задават с cursor.
+
+        Резултатът е (result, cursor), като cursor е (sort_key, nid) на
+        последното върнато съобщение или None след последната страница.
+        Следващата страница започва след cursor, дори списъкът да се е
+        променил междувременно. При page <= 0 се връщат всички съобщения.
+        """
 
-            nid_list.sort(key=lambda x: (x[1] is None, x[1]), reverse=order_reverse)
-            self._sorted_nid[cache_key] = nid_list
+        keys, nid_list = self._sorted_nids(folder, order_by)
+        size = len(nid_list)
+        if cursor is None:
+            start = 0
+        elif order_reverse:
+            start = size - bisect_left(keys, cursor)
+        else:
+            start = bisect_right(keys, cursor)
+        end = start + page if page > 0 else size
+        result = self._message_rows(
+            self._page_slice(nid_list, start, end, order_reverse), fields)
+        if end >= size:
+            return result, None
+        return result, keys[size - end if order_reverse else end - 1]
 
+    @staticmethod
+    def _page_slice(items, start, end, reverse):
+        """items[start:end], като при reverse items се обхождат от края."""
+
+        if not reverse:
+            return items[start:end]
+        size = len(items)
+        return items[max(0, size - end):max(0, size - start)][::-1]
+
+    def _message_rows(self, nids, fields):
+        row_cache = self.get_row_cache()
+        if not row_cache.has_fields(fields):
+            row_cache = None
         result = []
-        skipped, nout = 0, 0
-        for nid, _ in nid_list:
-            if skipped < skip:
-                skipped += 1
+        for nid in nids:
+            row = row_cache.get_row(nid, fields) if row_cache is not None else None
+            if row is not None:
+                result.append([nid, *row])
                 continue
-            if page > 0 and nout == page:
-                return result
-            nout += 1
             pv = [nid]
             result.append(pv)
             pc = PropertyContext(self._mbox, nid)
@@ -138,6 +253,40 @@ class MboxCacheEntry:
                 pv.append(value)
         return result
 
+    def _sorted_nids(self, folder, order_by):
+        """(keys, nids) на съобщенията в папката по нарастване на order_by.
+
+        keys са (sort_key, nid), като sort_key е позицията в колоната на
+        SortColumnsIndex, а за останалите полета - самата стойност.
+        """
+
+        order_by = order_by if order_by is not None else 'MessageDeliveryTime'
+        cache_key = folder, order_by
+        sorted_nids = self._sorted_nid.get(cache_key)
+        if sorted_nids is not None:
+            return sorted_nids
+
+        sort_columns = self.get_sort_columns()
+        if sort_columns.has_key(order_by):
+            # подредбата е от индекса, остава само да се приложи филтъра
+            column = sort_columns.get_column(folder, order_by)
+            keys = list(enumerate(column))
+            if self._search_match_nids is not None:
+                folder_nids = {nid for nid, nidp in self._message if nidp == folder}
+                keys = [key for key in keys if key[1] in folder_nids]
+        else:
+            keys = []
+            for nid, nidp in self._message:
+                if nidp != folder:
+                    continue
+                pc = PropertyContext(self._mbox, nid)
+                value = pc.get_value(order_by)
+                keys.append(((value is None, value), nid))
+            keys.sort()
+        sorted_nids = keys, [nid for _, nid in keys]
+        self._sorted_nid[cache_key] = sorted_nids
+        return sorted_nids
+
     @staticmethod
     def _mime_type(pa):
         mime_name = pa.alt_name("AttachMimeTag")
@@ -194,7 +343,7 @@ class MboxCacheEntry:
         name, _ex = os.path.splitext(os.path.basename(self._ifile))
         topic_idx = f"{name}_topic.idx"
         topic_idx = os.path.join(self._index_dir, topic_idx)
-        if not self._is_uptodate_index(topic_idx):
+        if not is_uptodate_index(self._ifile, topic_idx):
             start_ = time()
             log.info("create topic map")
             topic_map = {}
@@ -222,7 +371,7 @@ class MboxCacheEntry:
         name, _ex = os.path.splitext(os.path.basename(self._ifile))
         cat_idx = f"{name}_categories.idx"
         cat_idx = os.path.join(self._index_dir, cat_idx)
-        if not self._is_uptodate_index(cat_idx):
+        if not is_uptodate_index(self._ifile, cat_idx):
             start_ = time()
             log.info("create categories map")
             cat_nids = []
@@ -326,20 +475,19 @@ class MboxCacheEntry:
         name, _ex = os.path.splitext(os.path.basename(self._ifile))
         msgids_idx = f"{name}_msgids.idx"
         msgids_fnm = os.path.join(self._index_dir, msgids_idx)
-        if self._is_uptodate_index(msgids_fnm):
+        if is_uptodate_index(self._ifile, msgids_fnm):
             with open(msgids_fnm, "rb") as fin:
                 self._msgids = pickle.load(fin)
         else:
             start_ = time()
             self._msgids = []
             ndb = self._mbox
-            for nx in ndb._nbt:
-                if nx["typeCode"] != "NORMAL_MESSAGE":
-                    continue
-                pc = PropertyContext(ndb, nx["nid"])
+            nids = [nx["nid"] for nx in ndb._nbt if nx["typeCode"] == "NORMAL_MESSAGE"]
+            for nid in ndb.schedule_reads(nids):
+                pc = PropertyContext(ndb, nid)
                 msgid = pc.get_value_safe("InternetMessageId", None)
                 if msgid is not None:
-                    self._msgids.append((nx["nid"], msgid))
+                    self._msgids.append((nid, msgid))
 
             with open(msgids_fnm, "wb") as fout:
                 pickle.dump(self._msgids, fout, pickle.HIGHEST_PROTOCOL)
@@ -356,12 +504,14 @@ class MboxCacheEntry:
         tx.add(nid)
         self._sync_tag_nid(tag, nid)
         self._save_tags()
+        self._invalidate_results()
 
     def del_tag(self, tag, nid):
         if tag in self._tags:
             self._tags[tag].discard(nid)
             self._tags_nid[nid].discard(tag)
             self._save_tags()
+            self._invalidate_results()
 
     def get_nid_tags(self, nid):
         nx = self._tags_nid.get(nid, None)
@@ -374,80 +524,170 @@ class MboxCacheEntry:
     def get_tag_nids(self, tag):
         return self._tags.get(tag, None)
 
-    def get_search_index(self, refresh=False):
-        if refresh:
+    def get_search_index(self, refresh=False, jobs=None, spill_limit=None):
+        """Индекс за търсене според search_backend (виж SEARCH_BACKENDS).
+
+        Ако pst файла е по-нов от индекса се преиндексира (за pickle само
+        променените папки), а с refresh се преиндексира всичко. jobs (по
+        подразбиране index_jobs) и spill_limit се ползват при индексиране.
+        """
+
+        if refresh and self._search_index is not None:
+            self._search_index.close()
             self._search_index = None
 
         if self._search_index is None:
             name, _ex = os.path.splitext(os.path.basename(self._ifile))
-            search_idx = f"{name}_search_body.idx"
-            search_idx = os.path.join(self._index_dir, search_idx)
-
-            if not self._is_uptodate_index(search_idx) or refresh:
-                search = SearchTextIndex(attrs=("Subject", "Body", ))
-                search.create(self.get_mbox())
-                search.save(search_idx)
+            search_base = os.path.join(self._index_dir, f"{name}_search_body")
+            backend = SEARCH_BACKENDS[self._search_backend]
+            options = {}
+            if backend is ShardedSearchIndex:
+                options["jobs"] = self._index_jobs if jobs is None else jobs
+                options["spill_limit"] = spill_limit
+            search = backend(search_base, attrs=("Subject", "Body", ), **options)
+            if not is_uptodate_index(self._ifile, search.index_name()) or refresh:
+                search.update(self.get_mbox(), force=refresh)
             else:
-                search = SearchTextIndex()
-                search.read(search_idx)
-            self._search_index = search.index
+                search.read()
+            self._search_index = search
+            # резултатите от предишни търсения са по стария индекс
+            self._invalidate_results()
 
         return self._search_index
 
-    def set_filter(self, search_string, match_mode=1, apply_mode=1):
+    def set_filter(self, search_string, match_mode=1, apply_mode=1, folder=None):
         """Търси по една или повече думи.
 
         match_mode - (1) започва като, (2) съдържа, (3) точно като
         apply_mode - (1) коя да е дума, (2) всички думи
+        folder - търси само в тази папка (зарежда се само нейния индекс)
         """
 
         if search_string is None or len(search_string) == 0:
             self._search_match_nids = None
+            self._index_content()
         else:
-            index = self.get_search_index()
-            self._search_match_nids = set()
-            search_words = search_string.lower().split()
-
-            for search_word in search_words:
-                found_set = set()
-                for word, nids in index.items():
-                    # pylint: disable=too-many-boolean-expressions
-                    # проверката е по типовете търсене и съответстващия критерий
-                    if (match_mode == 1 and word.startswith(search_word) or
-                            match_mode == 2 and search_word in word or
-                            match_mode == 3 and word == search_word):
-                        found_set.update(nids)
-
-                if apply_mode == 1:
-                    self._search_match_nids.update(found_set)
-                elif apply_mode == 2:
-                    if len(self._search_match_nids) == 0:
-                        self._search_match_nids.update(found_set)
-                    else:
-                        self._search_match_nids.intersection_update(found_set)
-                    if len(self._search_match_nids) == 0:
-                        break
-        self._index_content()
+            cache_key = QueryCache.make_key(search_string, match_mode, apply_mode, folder)
+            cached = self._query_cache.get(cache_key)
+            if cached is not None:
+                self._search_match_nids = cached.nids
+                self._message = cached.messages
+                self._message_counts = cached.counts
+                self._sorted_nid = {}
+            else:
+                self._search_match_nids = self._search_words(
+                    search_string, match_mode, apply_mode, folder)
+                self._index_content()
+                self._query_cache.put(cache_key, QueryResult(
+                    self._search_match_nids, self._message, self._message_counts))
         return {'nid': self._message[0][1]} if len(self._message) > 0 else None
 
+    def _search_words(self, search_string, match_mode, apply_mode, folder=None):
+        index = self.get_search_index()
+        folders = [folder] if folder is not None else None
+        match_nids = None
+        search_words = search_string.lower().split()
+
+        for search_word in search_words:
+            found = self.to_bitmap(index.find_word(search_word, match_mode, folders))
+
+            if match_nids is None:
+                match_nids = found
+            elif apply_mode == 1:
+                match_nids = match_nids | found
+            elif apply_mode == 2:
+                match_nids = match_nids & found
+            if apply_mode == 2 and not match_nids:
+                break
+        return match_nids if match_nids is not None else self.to_bitmap(())
+
     def search_linked_messages(self, nid):
         log.info('linked to %d', nid)
-        pc = PropertyContext(self.get_mbox(), int(nid))
-        topic_list = self.topic_index().get(self.topic_key(pc))
-        self._search_match_nids = {x_[0] for x_ in topic_list}
+        thread = self.get_thread_index().thread(int(nid))
+        if len(thread) == 0:
+            return None
+        self._search_match_nids = self.to_bitmap(thread)
         self._index_content()
         # папката (една от всички) в която има свързани съобщения
-        return {'nid': topic_list[0][1]} if len(topic_list) > 0 else None
+        return {'nid': self._mbox._nbtx[thread[0]]["nidParent"]}
 
-    def search_tags(self):
-        self._search_match_nids = self._tags_nid.keys()
-        self._index_content()
-        return {'nid': self._message[0][1]} if len(self._message) > 0 else None
+    def tags_bitmap(self, tag=None):
+        """Съобщенията с маркера или с кой да е маркер при None."""
+
+        if tag is not None:
+            return self.to_bitmap(self._tags.get(tag, ()))
+        return self.to_bitmap(nid for nid, tags in self._tags_nid.items() if tags)
+
+    def search_tags(self, tag=None):
+        return self._apply_match(self.tags_bitmap(tag))
+
+    def search_dates(self, start=None, end=None):
+        """Съобщенията, получени в периода start <= MessageDeliveryTime < end."""
+
+        return self._apply_match(self.get_date_index().range(start, end))
+
+    def search_address(self, prefix, roles=None):
+        """Съобщенията с подател/получател, започващ с prefix.
+
+        roles - ограничава търсенето до from, to и/или cc (по подразбиране всички)
+        """
+
+        return self._apply_match(self.get_address_index().lookup(prefix, roles))
+
+    def apply_filters(self, filters):
+        """Прилага веригата от филтри (MboxFilters или списък (oper, params))."""
+
+        if isinstance(filters, MboxFilters):
+            filters = filters.filters
+        if len(filters) == 0:
+            return self._apply_match(None)
+        return self._apply_match(self._filter_eval.evaluate(filters))
+
+    def search_categories(self, category=None):
+        """Съобщенията с категорията или всички с категории при None."""
+
+        return self._apply_match(self.get_category_index().lookup(category))
+
+
+QueryResult = namedtuple('QueryResult', ['nids', 'messages', 'counts'])
 
-    def search_categories(self):
-        self._search_match_nids = self.categories_index()
-        self._index_content()
-        return {'nid': self._message[0][1]} if len(self._message) > 0 else None
+
+class QueryCache:
+    """LRU cache на резултатите от търсене.
+
+    Ключът е нормализирания текст за търсене заедно с режимите на търсене, а
+    стойността е QueryResult: намерените nid, съобщенията (nid, nidp) и броя
+    им по папки. Съдържанието се изчиства при всяка промяна на индекса за
+    търсене или на маркерите.
+    """
+
+    def __init__(self, max_size=64):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(search_string, *modes):
+        # последователността и повторенията на думите не влияят на резултата
+        words = sorted(set(search_string.lower().split()))
+        return (" ".join(words), *modes)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
 
 
 class HiddenField:
@@ -548,6 +788,149 @@ class MboxFilters:
             pickle.dump(self.filters, fout, pickle.HIGHEST_PROTOCOL)
 
 
+class FilterEvaluator:
+    """Изчислява веригата от MboxFilters като операции върху NidBitmap.
+
+    Всеки филтър е (oper, params). Параметрите определят източниците (виж
+    SOURCES), чиито резултати се комбинират с AND; след това резултатът се
+    прилага към натрупаното до момента според oper: A - OR, F - AND, M -
+    ANDNOT. Ако веригата не започва с A, началото е всички съобщения.
+
+    Пазят се резултатите след всеки префикс на веригата, така че при промяна
+    на последния филтър се изчислява само той. Резултатите на отделните
+    източници също се пазят, докато индексите или маркерите не се променят.
+    """
+
+    # параметър: (метод, допълнителни параметри за същия източник)
+    SOURCES = MappingProxyType({
+        "search": ("_source_search", ("match_mode", "apply_mode", "folder")),
+        "tag": ("_source_tag", ()),
+        "tags": ("_source_tags", ()),
+        "category": ("_source_category", ()),
+        "categories": ("_source_categories", ()),
+        "date_from": ("_source_dates", ("date_to",)),
+        "date_to": ("_source_dates", ("date_from",)),
+        "address": ("_source_address", ("roles",)),
+        "thread": ("_source_thread", ()),
+        "folder": ("_source_folder", ()),
+    })
+    # параметри, които само уточняват някой от източниците
+    PARAMS = frozenset({"match_mode", "apply_mode", "roles"})
+
+    def __init__(self, mbox):
+        self._mbox = mbox
+        self._prefix = []
+        self._sources = {}
+
+    def clear(self):
+        self._prefix = []
+        self._sources = {}
+
+    @staticmethod
+    def _freeze(value):
+        if isinstance(value, set):
+            return tuple(sorted(value))
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+
+    def compile(self, filters):
+        """План: списък (oper, ((source, args), ...)) по реда на филтрите."""
+
+        plan = []
+        for oper, params in filters:
+            if oper not in ("A", "F", "M"):
+                raise KeyError(oper)
+            sources = set()
+            for name in params:
+                if name in self.SOURCES:
+                    method, extra = self.SOURCES[name]
+                    args = tuple((x, self._freeze(params[x]))
+                                 for x in sorted((name, *extra)) if x in params)
+                    sources.add((method, args))
+                elif name not in self.PARAMS:
+                    raise KeyError(name)
+            plan.append((oper, tuple(sorted(sources, key=repr))))
+        return plan
+
+    def evaluate(self, filters):
+        plan = self.compile(filters)
+        if len(plan) == 0:
+            # без филтри се виждат всички съобщения
+            self._prefix = []
+            return self._mbox._nid_space.full()
+        same = 0
+        while (same < len(plan) and same < len(self._prefix) and
+               self._prefix[same][0] == plan[same]):
+            same += 1
+        self._prefix = self._prefix[:same]
+
+        if same > 0:
+            result = self._prefix[-1][1]
+        elif plan[0][0] == "A":
+            result = self._mbox.to_bitmap(())
+        else:
+            result = self._mbox._nid_space.full()
+
+        for step in plan[same:]:
+            oper, sources = step
+            found = None
+            for source in sources:
+                bitmap = self._source(source)
+                found = bitmap if found is None else found & bitmap
+            if found is None:
+                found = self._mbox._nid_space.full()
+            if oper == "A":
+                result = result | found
+            elif oper == "F":
+                result = result & found
+            else:
+                result = result - found
+            self._prefix.append((step, result))
+        return result
+
+    def _source(self, source):
+        bitmap = self._sources.get(source)
+        if bitmap is None:
+            method, args = source
+            bitmap = self._mbox.to_bitmap(getattr(self, method)(**dict(args)))
+            self._sources[source] = bitmap
+        return bitmap
+
+    def _source_search(self, search, match_mode=1, apply_mode=1, folder=None):
+        return self._mbox._search_words(search, match_mode, apply_mode, folder)
+
+    def _source_tag(self, tag):
+        return self._mbox.tags_bitmap(tag)
+
+    def _source_tags(self, tags):
+        if tags:
+            return self._mbox.tags_bitmap()
+        return self._mbox._nid_space.full() - self._mbox.tags_bitmap()
+
+    def _source_category(self, category):
+        return self._mbox.get_category_index().lookup(category)
+
+    def _source_categories(self, categories):
+        index = self._mbox.get_category_index()
+        if categories:
+            return index.lookup()
+        return self._mbox._nid_space.full() - self._mbox.to_bitmap(index.lookup())
+
+    def _source_dates(self, date_from=None, date_to=None):
+        return self._mbox.get_date_index().range(date_from, date_to)
+
+    def _source_address(self, address, roles=None):
+        return self._mbox.get_address_index().lookup(address, roles)
+
+    def _source_thread(self, thread):
+        return self._mbox.get_thread_index().thread(thread)
+
+    def _source_folder(self, folder):
+        nbtx = self._mbox.get_mbox()._nbtx
+        return (nid for nid in self._mbox._nid_space.nids if nbtx[nid]["nidParent"] == folder)
+
+
 class TagsList:
     """Маркери (tags) за поставяне по имейлите."""
 
@@ -596,12 +979,24 @@ class SearchTextIndex:
     Разбиването на думи и изчистването е реализирано тук без да се използват
     допълнителни пакети (например като nltk). Не е най-качественото, но за
     целта на търсене, може би, е напълно достатъчно.
+
+    При jobs > 1 или зададено spill_limit съобщенията се разделят на части,
+    които се обработват в отделни процеси. Всеки процес записва сортирани
+    двойки (дума, nid) във временни файлове, като в паметта държи най-много
+    spill_limit двойки. Накрая файловете се сливат (k-way merge) в индекса.
     """
 
-    def __init__(self, attrs=("Subject",), _min_len=4):
+    # най-малката дължина на индексираните думи
+    MIN_LEN = 4
+
+    def __init__(self, attrs=("Subject",), _min_len=MIN_LEN, jobs=1, spill_limit=None,
+                 tmp_dir=None):
         self.index = {}
         self._attrs = attrs
         self._min_len = _min_len
+        self._jobs = max(1, jobs or os.cpu_count() or 1)
+        self._spill_limit = spill_limit
+        self._tmp_dir = tmp_dir
         self._stop_words = set()
         # само истински думи - с букви
         self._words_split_re = f'([a-zA-Zа-яА-Я]{{{self._min_len},}})'
@@ -617,38 +1012,96 @@ class SearchTextIndex:
             self._attrs, self.index = pickle.load(fin)
         log.debug("%s", f"прочетен е индекс за търсене с {len(self.index):>,d} елемента")
 
-    def create(self, ndb):
-        self._stop_words = self._load_stop_words()
-        self._process_mbox(ndb)
+    def create(self, ndb, nids=None):
+        """Индексира съобщенията nids или всички, ако не са зададени."""
 
-    def _process_mbox(self, ndb):
+        self._stop_words = self._load_stop_words()
+        self._process_mbox(ndb, nids)
+        self._debug_index(self.index.items())
+
+    def find_word(self, search_word, match_mode=1):
+        found_set = set()
+        for word, nids in self.index.items():
+            # pylint: disable=too-many-boolean-expressions
+            # проверката е по типовете търсене и съответстващия критерий
+            if (match_mode == 1 and word.startswith(search_word) or
+                    match_mode == 2 and search_word in word or
+                    match_mode == 3 and word == search_word):
+                found_set.update(nids)
+        return found_set
+
+    def _process_mbox(self, ndb, nids=None):
         start = time()
-        for nx in ndb._nbt:
-            if nx["typeCode"] == "NORMAL_MESSAGE":
-                nid = nx["nid"]
+        if nids is None:
+            nids = [nx["nid"] for nx in ndb._nbt if nx["typeCode"] == "NORMAL_MESSAGE"]
+        if self._jobs > 1 or self._spill_limit is not None:
+            self._process_partitions(ndb, nids)
+        else:
+            for nid in ndb.schedule_reads(nids):
                 self._update(PropertyContext(ndb, nid), nid)
         self._sweep_analyze()
-        self._debug_index()
         log.info("%s", f"индексирането за търсене завърши за {time()-start:>,.3f} сек.")
 
-    def _update(self, pc, nid):
-        for attr in self._attrs:
-            text = pc.get_value_safe(attr)
+    def _process_partitions(self, ndb, nids):
+        # повече части от процесите, за да се изравни натоварването
+        parts = self._jobs * 4
+        # всяка част е от съседни във файла съобщения
+        nids = ndb.physical_order(nids)
+        part_size = max(1, -(-len(nids) // parts))
+        spill_limit = self._spill_limit or 1_000_000
+        tmp_dir = mkdtemp(prefix="readms_search_", dir=self._tmp_dir)
+        try:
+            tasks = [(ndb._file_name, ndb._index_dir, nids[px:px+part_size],
+                      self._attrs, self._min_len, self._stop_words,
+                      spill_limit, tmp_dir, px)
+                     for px in range(0, len(nids), part_size)]
+            runs = [x for part_runs in _run_partitions(tasks, self._jobs) for x in part_runs]
+            log.info("%s", f"{len(nids):>,d} съобщения в {len(runs):>,d} временни файла")
+            self._merge_runs(runs)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _merge_runs(self, runs):
+        self.index = {}
+        with ExitStack() as stack:
+            fins = [stack.enter_context(open(fnm, encoding="UTF-8")) for fnm in runs]
+            pairs = (line.rstrip("\n").split("\t") for line in heap_merge(*fins))
+            for word, group in groupby(pairs, key=lambda x: x[0]):
+                self.index[word] = {int(nid) for _, nid in group}
 
+    @staticmethod
+    def _attr_text(pc, attr):
+        if attr == "Body":
+            return message_body_text(pc)
+        text = pc.get_value_safe(attr)
+        if attr == "Subject":
+            text = text[2:] if text is not None else None
+        return text
+
+    def _message_words(self, pc):
+        words = set()
+        for attr in self._attrs:
             # извличане на списъка с думи
-            if attr == "Subject":
-                text = text[2:] if text is not None else None
-            text = self._split_words(text)
-            text = self._sweep_stop_worlds(text)
-
-            # актуализиране на индекса за всяка дума
-            if text is not None:
-                for word in text:
-                    nids = self.index.get(word, None)
-                    if nids is None:
-                        nids = set()
-                        self.index[word] = nids
-                    nids.add(nid)
+            text = self._split_words(self._attr_text(pc, attr))
+            words.update(self._sweep_stop_worlds(text))
+        return words
+
+    def _text_words(self, text):
+        """Думите на text по реда им в текста, без stop words."""
+
+        if text is None:
+            return []
+        words = (word.lower() for word in self._words_split_re.findall(text))
+        return [word for word in words if word not in self._stop_words]
+
+    def _update(self, pc, nid):
+        # актуализиране на индекса за всяка дума
+        for word in self._message_words(pc):
+            nids = self.index.get(word, None)
+            if nids is None:
+                nids = set()
+                self.index[word] = nids
+            nids.add(nid)
 
     def _split_words(self, text):
         result = set()
@@ -662,6 +1115,7 @@ class SearchTextIndex:
         return text - self._stop_words
 
     @staticmethod
+    @lru_cache(maxsize=1)
     def _load_stop_words():
         try:
             result = set()
@@ -700,8 +1154,384 @@ class SearchTextIndex:
                 log.debug("    %s", "{word} ({lx:>,d}) ({1.0*lx/len_nids:>,.3f})")
         log.debug("%s", f"най-дълъг индекс: {s2:>,d}")
 
-    def _debug_index(self):
+    @staticmethod
+    def _debug_index(items):
         if log.isEnabledFor(logging.DEBUG):
             with open_enc("search_index_debug.txt", "wb", "UTF-8") as fout:
-                for ex, nids in self.index.items():
+                for ex, nids in items:
                     print(ex, nids, file=fout)
+
+
+class ShardedSearchIndex:
+    """Индекс за търсене, разделен по папки.
+
+    За всяка папка (nidParent на съобщенията) се поддържа отделен
+    SearchTextIndex във файл <folder>.idx в директорията на индекса. В
+    manifest.idx се пази подпис на съдържанието на всяка папка, изчислен
+    от NBT (nid, bidData, bidSub на съобщенията) без четене на PC. При
+    актуализация се преиндексират само папките с променен подпис, при
+    jobs > 1 или зададено spill_limit като едно общо разделено на части
+    индексиране (виж _index_partition). Всяка папка се записва веднага след
+    индексирането ѝ, така че в паметта се държи най-много един индекс.
+
+    Индексите на папките се зареждат при първото търсене в тях и се
+    преглеждат последователно.
+    """
+
+    MANIFEST_NAME = "manifest.idx"
+
+    def __init__(self, index_dir, attrs=("Subject",), jobs=1, spill_limit=None):
+        self._index_dir = index_dir
+        self._attrs = attrs
+        self._jobs = max(1, jobs or os.cpu_count() or 1)
+        self._spill_limit = spill_limit
+        self._manifest = {}
+        self._shards = {}
+
+    def index_name(self):
+        return os.path.join(self._index_dir, self.MANIFEST_NAME)
+
+    def _shard_name(self, folder):
+        return os.path.join(self._index_dir, f"{folder}.idx")
+
+    def read(self):
+        with open(self.index_name(), "rb") as fin:
+            attrs, self._manifest = pickle.load(fin)
+        if tuple(attrs) != tuple(self._attrs):
+            log.warning("индексът е създаден за %s, а не за %s", attrs, self._attrs)
+        self._shards = {}
+
+    def _save_manifest(self):
+        with open(self.index_name(), "wb") as fout:
+            pickle.dump((self._attrs, self._manifest), fout, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def folder_signatures(ndb):
+        folders = {}
+        for nx in ndb._nbt:
+            if nx["typeCode"] != "NORMAL_MESSAGE":
+                continue
+            folders.setdefault(nx["nidParent"], []).append(
+                (nx["nid"], nx["bidData"], nx["bidSub"]))
+        result = {}
+        for folder, entries in folders.items():
+            entries.sort()
+            md5 = hashlib.md5()
+            md5.update(repr(entries).encode("ASCII"))
+            result[folder] = (md5.hexdigest(), [x[0] for x in entries])
+        return result
+
+    def update(self, ndb, force=False):
+        """Преиндексира папките, чието съдържание е променено."""
+
+        start = time()
+        if not os.path.exists(self._index_dir):
+            os.makedirs(self._index_dir)
+        if not force and os.path.exists(self.index_name()):
+            self.read()
+        else:
+            self._manifest = {}
+
+        signatures = self.folder_signatures(ndb)
+        changed = {}
+        for folder, (signature, nids) in signatures.items():
+            if (self._manifest.get(folder) != signature or
+                    not os.path.exists(self._shard_name(folder))):
+                changed[folder] = nids
+
+        self._shards = {}
+        # всяка папка се записва веднага, в паметта е най-много един индекс
+        for folder, search in self._build_shards(ndb, changed):
+            search.save(self._shard_name(folder))
+            self._manifest[folder] = signatures[folder][0]
+        SearchTextIndex._debug_index(self._read_items(changed))
+
+        for folder in set(self._manifest) - set(signatures):
+            del self._manifest[folder]
+            if os.path.exists(self._shard_name(folder)):
+                os.unlink(self._shard_name(folder))
+
+        self._save_manifest()
+        log.info("%s", f"преиндексирани са {len(changed):>,d} от {len(signatures):>,d} "
+                       f"папки за {time()-start:>,.3f} сек.")
+
+    def _build_shards(self, ndb, changed):
+        """Генерира (папка, SearchTextIndex) за папките changed една по една."""
+
+        if self._jobs > 1 or self._spill_limit is not None:
+            yield from self._build_partitions(ndb, changed)
+            return
+        stop_words = SearchTextIndex._load_stop_words()
+        for folder, nids in changed.items():
+            search = SearchTextIndex(attrs=self._attrs)
+            search._stop_words = stop_words
+            search._process_mbox(ndb, nids)
+            yield folder, search
+
+    def _read_items(self, folders):
+        for folder in folders:
+            shard = SearchTextIndex(attrs=self._attrs)
+            shard.read(self._shard_name(folder))
+            yield from shard.index.items()
+
+    def _build_partitions(self, ndb, changed):
+        """Индексира папките changed като общо разделено на части индексиране.
+
+        Съобщенията на всяка папка се разделят на части от съседни във файла
+        съобщения, а частите на всички папки се изпълняват в един пул от
+        процеси (при jobs = 1 в текущия процес); временните файлове на всяка
+        папка се сливат в нейния индекс, който се връща преди да се слее
+        следващата папка.
+        """
+
+        total = sum(len(nids) for nids in changed.values())
+        part_size = max(1, -(-total // (self._jobs * 4)))
+        stop_words = SearchTextIndex._load_stop_words()
+        tmp_dir = mkdtemp(prefix="readms_search_")
+        try:
+            tasks, task_folders = [], []
+            for folder, nids in changed.items():
+                nids = ndb.physical_order(nids)
+                for px in range(0, len(nids), part_size):
+                    tasks.append((ndb._file_name, ndb._index_dir, nids[px:px+part_size],
+                                  self._attrs, SearchTextIndex.MIN_LEN, stop_words,
+                                  self._spill_limit or 1_000_000, tmp_dir, len(tasks)))
+                    task_folders.append(folder)
+            runs = {folder: [] for folder in changed}
+            for folder, part_runs in zip(task_folders, _run_partitions(tasks, self._jobs)):
+                runs[folder].extend(part_runs)
+            for folder, folder_runs in runs.items():
+                search = SearchTextIndex(attrs=self._attrs)
+                search._merge_runs(folder_runs)
+                yield folder, search
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def close(self):
+        self._shards = {}
+
+    def folders(self):
+        return list(self._manifest.keys())
+
+    def get_shard(self, folder):
+        shard = self._shards.get(folder)
+        if shard is None:
+            shard = SearchTextIndex(attrs=self._attrs)
+            if folder in self._manifest:
+                shard.read(self._shard_name(folder))
+            self._shards[folder] = shard
+        return shard
+
+    def find_word(self, search_word, match_mode=1, folders=None):
+        """Търси думата в индексите на зададените папки (всички при None)."""
+
+        folders = self.folders() if folders is None else folders
+        found_set = set()
+        for folder in folders:
+            found_set.update(self.get_shard(folder).find_word(search_word, match_mode))
+        return found_set
+
+    def items(self):
+        """Всички (дума, nids) по папки; една дума може да се срещне повече от веднъж."""
+
+        for folder in self.folders():
+            yield from self.get_shard(folder).index.items()
+
+
+class SqliteSearchIndex:
+    """Индекс за търсене в SQLite FTS5 таблица.
+
+    Индексът не се зарежда в паметта на процеса, а се чете от файла
+    <name>_search_body.sqlite през page cache с ограничен размер, така че
+    може да се ползва едновременно от няколко процеса. За rowid на
+    таблицата се използва nid на съобщението, а папката е неиндексирана
+    колона. Освен find_word, със search се поддържа пълния синтаксис на FTS5
+    (фрази, префикси) с подреждане по BM25.
+
+    В таблицата се записват думите, извлечени по правилата на SearchTextIndex
+    (минимална дължина, stop words), така че двата индекса намират едни и
+    същи съобщения.
+
+    Една връзка към базата се ползва от всички нишки (check_same_thread е
+    изключен), като отварянето, затварянето и записа са под self._lock.
+    """
+
+    # най-много термове в един израз при търсене в средата на думата
+    MAX_TERMS = 500
+
+    def __init__(self, index_base, attrs=("Subject",), batch_size=10_000, cache_kb=16_384):
+        self._file_name = f"{index_base}.sqlite"
+        self._attrs = attrs
+        self._columns = [attr.lower() for attr in attrs]
+        self._batch_size = batch_size
+        self._cache_kb = cache_kb
+        self._db = None
+        self._lock = threading.Lock()
+        self._words = SearchTextIndex(attrs)
+
+    def index_name(self):
+        return self._file_name
+
+    def _connect(self):
+        with self._lock:
+            if self._db is None:
+                db = sqlite3.connect(self._file_name, check_same_thread=False)
+                db.execute(f"PRAGMA cache_size=-{self._cache_kb:d}")
+                db.execute("PRAGMA journal_mode=WAL")
+                self._db = db
+            return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def read(self):
+        self._connect()
+
+    def update(self, ndb, force=False):
+        """Създава наново индекса; FTS5 няма смисъл да се обновява частично по папки."""
+
+        start = time()
+        db = self._connect()
+        with self._lock:
+            count = self._rebuild(db, ndb)
+        log.info("%s", f"индексирани са {count:>,d} съобщения в {self._file_name} "
+                       f"за {time()-start:>,.3f} сек.")
+
+    def _rebuild(self, db, ndb):
+        self._words._stop_words = SearchTextIndex._load_stop_words()
+        columns = ", ".join(self._columns)
+        db.execute("DROP TABLE IF EXISTS messages_vocab")
+        db.execute("DROP TABLE IF EXISTS messages")
+        db.execute(f"CREATE VIRTUAL TABLE messages USING fts5("
+                   f"folder UNINDEXED, {columns}, "
+                   f"tokenize='unicode61 remove_diacritics 0', prefix='2 3')")
+        db.execute("CREATE VIRTUAL TABLE messages_vocab USING fts5vocab(messages, 'row')")
+
+        insert = (f"INSERT INTO messages(rowid, folder, {columns}) "
+                  f"VALUES (?, ?{', ?' * len(self._columns)})")
+        rows, count = [], 0
+        messages = [nx for nx in ndb._nbt if nx["typeCode"] == "NORMAL_MESSAGE"]
+        for nx in ndb.schedule_reads(messages, key=lambda nx: nx["nid"]):
+            rows.append(self._message_row(PropertyContext(ndb, nx["nid"]), nx))
+            if len(rows) >= self._batch_size:
+                count += self._insert_rows(db, insert, rows)
+        count += self._insert_rows(db, insert, rows)
+
+        with db:
+            db.execute("INSERT INTO messages(messages) VALUES ('optimize')")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return count
+
+    @staticmethod
+    def _insert_rows(db, insert, rows):
+        # голяма транзакция за всяка група, иначе всеки ред е отделна транзакция
+        count = len(rows)
+        if count > 0:
+            with db:
+                db.executemany(insert, rows)
+            rows.clear()
+        return count
+
+    def _message_row(self, pc, nx):
+        row = [nx["nid"], nx["nidParent"]]
+        for attr in self._attrs:
+            text = self._words._attr_text(pc, attr)
+            row.append(" ".join(self._words._text_words(text)))
+        return row
+
+    @staticmethod
+    def _quote(word):
+        return '"{}"'.format(word.replace('"', '""'))
+
+    def _match_exprs(self, search_word, match_mode):
+        if match_mode == 1:
+            yield f"{self._quote(search_word)}*"
+            return
+        if match_mode == 3:
+            yield self._quote(search_word)
+            return
+        # FTS5 не поддържа търсене в средата на дума, затова се търси в речника,
+        # а намерените термове се търсят на групи от най-много MAX_TERMS
+        terms = self._connect().execute(
+            "SELECT term FROM messages_vocab WHERE instr(term, ?) > 0", (search_word,))
+        batch = terms.fetchmany(self.MAX_TERMS)
+        while batch:
+            yield " OR ".join(self._quote(term) for term, in batch)
+            batch = terms.fetchmany(self.MAX_TERMS)
+
+    @staticmethod
+    def _folders_filter(folders):
+        if folders is None:
+            return "", []
+        return f" AND folder IN ({', '.join('?' * len(folders))})", list(folders)
+
+    def find_word(self, search_word, match_mode=1, folders=None):
+        folders_sql, folders_args = self._folders_filter(folders)
+        sql = f"SELECT rowid FROM messages WHERE messages MATCH ?{folders_sql}"
+        found_set = set()
+        for expr in list(self._match_exprs(search_word.lower(), match_mode)):
+            rows = self._connect().execute(sql, [expr, *folders_args])
+            found_set.update(nid for nid, in rows)
+        return found_set
+
+    def search(self, query, folders=None, limit=None):
+        """Търсене по FTS5 израз; резултатът е [(nid, bm25)] по релевантност."""
+
+        folders_sql, folders_args = self._folders_filter(folders)
+        sql = (f"SELECT rowid, bm25(messages) FROM messages "
+               f"WHERE messages MATCH ?{folders_sql} ORDER BY bm25(messages)")
+        args = [query, *folders_args]
+        if limit is not None:
+            sql = f"{sql} LIMIT ?"
+            args.append(limit)
+        return self._connect().execute(sql, args).fetchall()
+
+
+SEARCH_BACKENDS = {
+    "pickle": ShardedSearchIndex,
+    "sqlite": SqliteSearchIndex,
+}
+
+
+def _run_partitions(tasks, jobs):
+    """Резултатите от _index_partition за tasks, при jobs > 1 от един пул от процеси."""
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(_index_partition, tasks))
+    return [_index_partition(task) for task in tasks]
+
+
+def _index_partition(task):
+    """Индексира част от съобщенията в отделен процес.
+
+    Резултатът е списък от временни файлове, всеки от които съдържа сортирани
+    редове дума<TAB>nid. Всеки процес отваря собствен NDBLayer.
+    """
+
+    file_name, index_dir, nids, attrs, min_len, stop_words, spill_limit, tmp_dir, part = task
+    search = SearchTextIndex(attrs=attrs, _min_len=min_len)
+    search._stop_words = stop_words
+    runs = []
+    pairs = []
+
+    def spill():
+        run_fnm = os.path.join(tmp_dir, f"run_{part:09d}_{len(runs):04d}.txt")
+        pairs.sort()
+        with open(run_fnm, "w", encoding="UTF-8") as fout:
+            fout.writelines(pairs)
+        runs.append(run_fnm)
+        pairs.clear()
+
+    with NDBLayer(file_name, index_dir) as ndb:
+        for nid in ndb.schedule_reads(nids):
+            for word in search._message_words(PropertyContext(ndb, nid)):
+                pairs.append(f"{word}\t{nid}\n")
+            if len(pairs) >= spill_limit:
+                spill()
+    if pairs:
+        spill()
+    return runs
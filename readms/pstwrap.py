@@ -18,13 +18,16 @@ class MboxWrapper:
         self.mbox = None
         self._pst_home = getcwd()
         self._index_dir = self._pst_home
+        self._index_jobs = 1
+        self._search_backend = "pickle"
         self.pst_file = None
 
     def open_mbox(self, pst_file):
         self.pst_file = pst_file
         if not path.isabs(pst_file):
             pst_file = path.join(self._pst_home, pst_file)
-        self.mbox = MboxCacheEntry(pst_file, self._index_dir)
+        self.mbox = MboxCacheEntry(pst_file, self._index_dir,
+                                   self._index_jobs, self._search_backend)
 
     def close_mbox(self):
         if self.mbox is not None:
@@ -37,11 +40,21 @@ class MboxWrapper:
     def set_pst_home(self, pst_home):
         self._pst_home = pst_home
 
+    def set_index_jobs(self, index_jobs):
+        self._index_jobs = index_jobs
+
+    def set_search_backend(self, search_backend):
+        self._search_backend = search_backend
+
     def init_mbox_wrapper(self, config):
         pst = config.get("app", "pstmbox_dir")
         idx = config.get("app", "pstmbox_index_dir")
         self.set_index_dir(idx)
         self.set_pst_home(pst)
+        # 0 - по един процес за всяко ядро
+        self.set_index_jobs(config.getint("app", "pstmbox_index_jobs", fallback=1))
+        # pickle или sqlite (виж pstmbox.SEARCH_BACKENDS)
+        self.set_search_backend(config.get("app", "pstmbox_search_backend", fallback="pickle"))
 
 
 class EnvConfig:
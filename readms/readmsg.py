@@ -187,7 +187,7 @@ class AttributesContainer:
             data_offset = 24
 
         obuf = ole.dire_read(dire)
-        for pos_ in range(data_offset, len(obuf)-data_offset, 16):
+        for pos_ in range(data_offset, len(obuf), 16):
             tag = list(unpackb("<HH", obuf, pos_))  # Property Tag (type, code)
             # 2.4.2.2 Variable Length Property or Multiple-Valued Property Entry
             # за тези с променлива дължина, стойността е размера на истинската стойност,
@@ -39,6 +39,7 @@ from readms.metapst import (
     nid_internal_types,
     nid_types,
     page_types,
+    prop_type_sizes,
     prop_types,
 )
 from readms.readutl import (
@@ -90,6 +91,13 @@ def read_ndb_page(fin, bref):
     return {"meta": meta, "entries": entries}
 
 
+# Параметри на предварителното четене (виж NDBLayer.schedule_reads)
+READ_BATCH_SIZE = 8 << 20     # блокове за група съобщения
+READ_MAX_GAP = 64 << 10       # празнина между блокове, която се прочита, вместо seek
+READ_MAX_RUN = 1 << 20        # най-много байта на едно четене
+READ_SUBNODE_LIMIT = 1 << 20  # по-големите subnodes се четат при нужда
+
+
 # pylint: disable=too-many-instance-attributes
 # Всички атрибути са необходими за описанието на NDB.
 class NDBLayer:
@@ -109,6 +117,8 @@ class NDBLayer:
             self._save_index()
         # тъй като файлът е read-only, за сега, hash структура също върши работа
         self._prop_internal = None
+        # bid -> прочетения блок (виж prefetch)
+        self._block_cache = {}
         self._done_time = time.time() - start
 
     def __enter__(self):
@@ -275,15 +285,21 @@ class NDBLayer:
             raise KeyError(c_level)
         return entries
 
+    @staticmethod
+    def _block_size(cb):
+        # block_size is near greater multiple by 64
+        # 16 is the trailer block size
+        return (((cb + 16) - 1) // 64 + 1) * 64
+
     def _read_block(self, bbt):
         bid, ib = bbt["bref"]
         # print "_read_block::bbt", bbt
-        # block_size is near greater multiple by 64
-        # 16 is the trailer block size
-        block_size = (((bbt["cb"] + 16) - 1) // 64 + 1) * 64
+        block_size = self._block_size(bbt["cb"])
         assert block_size <= 8192  # 8176 + block trailer(16)
-        self._fin.seek(ib)
-        buf = memoryview(self._fin.read(block_size))
+        buf = self._block_cache.get(bid)
+        if buf is None:
+            self._fin.seek(ib)
+            buf = memoryview(self._fin.read(block_size))
         # dump_hex(buf)
         # block trailer is the last 16 bytes
         eng = UnpackDesc(buf, pos=block_size-16)
@@ -336,6 +352,34 @@ class NDBLayer:
             data = memoryview(out_data)
         return data
 
+    def _iter_data_block(self, bid):
+        """Както _read_data_block, но връща данните по блокове, без да ги събира."""
+
+        bx = self._bbtx[bid]
+        data = self._read_block(bx)
+        if not bx["internal"]:
+            yield data
+            return
+        sign, pos = self._read_block_sign(data)
+        assert sign["btype"] == 1
+        for bidx in unpackb(f"<{sign['cEnt']}Q", data, pos+4):
+            yield from self._iter_data_block(bidx)
+
+    def _data_block_size(self, bid):
+        bx = self._bbtx[bid]
+        if not bx["internal"]:
+            return bx["cb"]
+        # lcbTotal от XBLOCK, XXBLOCK
+        data = self._read_block(bx)
+        _sign, pos = self._read_block_sign(data)
+        return unpackb("<L", data, pos)[0]
+
+    def iter_nid(self, nid, hnid=None):
+        return self._iter_data_block(self._get_bid(nid, hnid))
+
+    def nid_data_size(self, nid, hnid=None):
+        return self._data_block_size(self._get_bid(nid, hnid))
+
     def _bid_size(self, bid):
         if bid != 0:
             bx = self._bbtx[bid]
@@ -367,6 +411,150 @@ class NDBLayer:
                              for x in entx.values()])
         return size
 
+    def _block_tree_size(self, bid):
+        """Размер (cb) на блока и на блоковете от неговото data tree."""
+
+        bx = self._bbtx.get(bid) if bid != 0 else None
+        if bx is None:
+            return 0
+        size = bx["cb"]
+        if bx["internal"]:
+            data = self._read_block(bx)
+            sign, pos = self._read_block_sign(data)
+            if sign["btype"] == 1:
+                # 2.2.2.8.3.2 Data Tree: XBLOCK (cLevel=1) и XXBLOCK (cLevel=2)
+                bids = unpackb(f"<{sign['cEnt']}Q", data, pos+4)
+                size += sum(self._block_tree_size(bidx) for bidx in bids)
+        return size
+
+    def nid_size_exact(self, nid):
+        """Точния размер на nid по BBT: данните, subnode btree и данните на subnodes.
+
+        За разлика от nid_size се прочитат вътрешните блокове на data trees
+        (XBLOCK, XXBLOCK), но не и съдържанието на PC.
+        """
+
+        nx = self._nbtx[nid]
+        size = self._block_tree_size(nx["bidData"]) + self._bid_size(nx["bidSub"])
+        for sx in nx.get("subEntries", {}).values():
+            size += self._block_tree_size(sx["bid"]) + self._bid_size(sx["bidSub"])
+        return size
+
+    def nid_blocks_size(self, nid):
+        """Размерът във файла на блоковете на nid и subnodes му, известни от NBT и BBT.
+
+        Не се чете нищо: за data trees се брои само горния блок (XBLOCK,
+        XXBLOCK), но не и блоковете под него.
+        """
+
+        nx = self._nbtx[nid]
+        bids = [nx["bidData"], nx["bidSub"]]
+        for sx in nx.get("subEntries", {}).values():
+            bids.extend((sx["bid"], sx["bidSub"]))
+        return sum(self._block_size(self._bbtx[bid]["cb"])
+                   for bid in bids if bid in self._bbtx)
+
+    def nid_offset(self, nid):
+        """Позицията (ib) във файла на блока с данните на nid; 0 ако няма такъв."""
+
+        bx = self._bbtx.get(self._nbtx[nid]["bidData"])
+        return bx["bref"][1] if bx is not None else 0
+
+    def physical_order(self, nids):
+        """Подрежда nids по позицията на данните им във файла."""
+
+        return sorted(nids, key=self.nid_offset)
+
+    def schedule_reads(self, items, key=None, batch_size=READ_BATCH_SIZE, **kwargs):
+        """Връща items, подредени по позицията на данните им във файла, на групи.
+
+        key(item) е nid на съобщението (по подразбиране самият item). Преди
+        всяка група блоковете на нейните nids се прочитат с prefetch, а след
+        нея се освобождават, така че обхождането на целия pst файл е почти
+        последователно четене. Размерът на групата е около batch_size байта
+        по nid_blocks_size, без четене от файла; kwargs се предават на prefetch.
+        """
+
+        key = key or (lambda x: x)
+        items = sorted(items, key=lambda x: self.nid_offset(key(x)))
+        pos = 0
+        try:
+            while pos < len(items):
+                end, size = pos, 0
+                while end < len(items) and (end == pos or size < batch_size):
+                    size += self.nid_blocks_size(key(items[end]))
+                    end += 1
+                self._block_cache.clear()
+                self.prefetch([key(x) for x in items[pos:end]], **kwargs)
+                yield from items[pos:end]
+                pos = end
+        finally:
+            self._block_cache.clear()
+
+    def prefetch(self, nids, subnode_limit=READ_SUBNODE_LIMIT, max_gap=READ_MAX_GAP):
+        """Прочита в кеша блоковете на nids с подредени по ib и обединени четения.
+
+        Първо се четат блоковете с данните на nids и на subnodes им, после
+        ниво по ниво блоковете от data trees (XBLOCK, XXBLOCK). Subnodes с
+        данни над subnode_limit байта (lcbTotal) се четат едва при нужда.
+        Връща броя на четенията от файла.
+        """
+
+        bids, limited = [], set()
+        for nid in nids:
+            nx = self._nbtx[nid]
+            bids.append(nx["bidData"])
+            for sx in nx.get("subEntries", {}).values():
+                bids.append(sx["bid"])
+                limited.add(sx["bid"])
+
+        reads = 0
+        while bids:
+            reads += self._read_blocks(bids, max_gap)
+            next_bids = []
+            for bid in bids:
+                bx = self._bbtx.get(bid)
+                if bx is None or not bx["internal"]:
+                    continue
+                data = self._read_block(bx)
+                sign, pos = self._read_block_sign(data)
+                if sign["btype"] != 1:
+                    continue
+                if bid in limited and unpackb("<L", data, pos)[0] > subnode_limit:
+                    continue
+                next_bids.extend(unpackb(f"<{sign['cEnt']}Q", data, pos+4))
+            bids = next_bids
+        return reads
+
+    def _read_blocks(self, bids, max_gap):
+        """Чете в кеша блоковете bids, подредени по ib; съседните с едно четене."""
+
+        blocks = {}
+        for bid in bids:
+            bx = self._bbtx.get(bid)
+            if bx is not None and bid not in self._block_cache:
+                blocks[bid] = (bx["bref"][1], self._block_size(bx["cb"]), bid)
+        blocks = sorted(blocks.values())
+
+        reads = pos = 0
+        while pos < len(blocks):
+            start = blocks[pos][0]
+            end = pos + 1
+            stop = start + blocks[pos][1]
+            while end < len(blocks):
+                ib, size, _bid = blocks[end]
+                if ib - stop > max_gap or ib + size - start > READ_MAX_RUN:
+                    break
+                stop = max(stop, ib + size)
+                end += 1
+            self._fin.seek(start)
+            buf = memoryview(self._fin.read(stop - start))
+            for ib, size, bid in blocks[pos:end]:
+                self._block_cache[bid] = buf[ib-start:ib-start+size]
+            reads += 1
+            pos = end
+        return reads
+
     def list_nids(self, nid_type, start_with=None):
         def nx_list(nodes, px=None):
             for nx in nodes:
@@ -611,6 +799,34 @@ class PropertyContext(NodeHeap):
             return self._buf[pos:pos+lx]
         return self._ndb.read_nid(self._nid, hnid)
 
+    def get_buffer_stream(self, ptag):
+        """Буфера на атрибута ptag като (размер, итератор по части).
+
+        Стойностите в subnode се четат блок по блок при итериране, така че
+        големи приложени файлове не се зареждат изцяло в паметта. За разлика
+        от get_buffer работи и за типове, които не са описани в prop_types.
+        """
+
+        px = self._props[ptag]
+        pt_size = prop_type_sizes.get(px["propType"], 0)
+        if 0 < pt_size <= 4:
+            buf = memoryview(bytearray(px["value"]))
+            return len(buf), iter((buf,))
+        hnid = ulong_from_tuple(px["value"])
+        if hnid == 0:
+            return 0, iter(())
+        if get_hnid_type(hnid) == "HID":
+            pos, lx = self._get_hid_pos_lx(px["value"])
+            return lx, iter((self._buf[pos:pos+lx],))
+        return self._ndb.nid_data_size(self._nid, hnid), self._ndb.iter_nid(self._nid, hnid)
+
+    def get_stream(self, prop_name):
+        """Буфера на атрибута като (размер, итератор по части) или None."""
+
+        if prop_name is None or prop_name not in self._propx:
+            return None
+        return self.get_buffer_stream(self._propx[prop_name])
+
     def get_value(self, prop_name):
         if prop_name is None or prop_name not in self._propx:
             return None
@@ -641,6 +857,8 @@ class PropertyNameMap(PropertyContext):
         # 0x0002 PidTagNameidStreamGuid
         # 0x0003 PidTagNameidStreamEntry
         # 0x0004 PidTagNameidStreamString
+        # Буферите на трите stream са със същия формат като в .msg (MS-OXMSG 2.2.3)
+        self.name_streams = {}
         self._guids = self._read_guid_stream()
         names = self._read_name_stream()
         self._props = self._read_string_stream(names)
@@ -692,7 +910,8 @@ class PropertyNameMap(PropertyContext):
     def _read_binary_data(self, tag):
         buf = self.get_buffer(tag)
         val = PropertyValue(0x0102, buf)
-        return val.get_value().data
+        self.name_streams[tag] = val.get_value().data
+        return self.name_streams[tag]
 
     def enrich_props(self, props):
         for prop in props:
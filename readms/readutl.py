@@ -1,9 +1,11 @@
 # -*- coding: UTF-8 -*-
 # vim:ft=python:et:ts=4:sw=4:ai
 
+import codecs
 import os
 import re
 from cProfile import Profile
+from html.parser import HTMLParser
 from pstats import Stats
 from struct import calcsize
 from struct import unpack_from as unpackb
@@ -247,6 +249,183 @@ def uncommpress_rtf(body):
     return out[prefix_len:]
 
 
+def rtf_from_compressed(body):
+    """RTF съдържанието на RtfCompressed като bytes.
+
+    Според [MS-OXRTFCP] 2.1.3.1.1 dwMagic 'MELA' означава некомпресирани
+    данни, а 'LZFu' - компресирани.
+    """
+
+    cb_rawsize = unpackb("<L", body[4:8])[0]
+    if bytes(body[8:12]) == b"MELA":
+        return bytes(body[16:16+cb_rawsize])
+    return bytes(uncommpress_rtf(body))
+
+
+class _HtmlTextParser(HTMLParser):
+    # таговете, след които текстът продължава на нов ред
+    _block_tags = frozenset({"br", "p", "div", "tr", "li", "table", "h1", "h2", "h3",
+                             "h4", "h5", "h6", "blockquote", "pre", "hr"})
+    _skip_tags = frozenset({"script", "style", "head", "title"})
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.out = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "body":
+            # незатворени head, style или script не скриват текста на body
+            self._skip = 0
+            self.clear_cdata_mode()
+        elif tag in self._skip_tags:
+            self._skip += 1
+        elif tag in self._block_tags:
+            self.out.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._skip_tags:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self._block_tags:
+            self.out.append("\n")
+
+    def set_cdata_mode(self, elem, **kwargs):
+        HTMLParser.set_cdata_mode(self, elem, **kwargs)
+        # съдържанието на script и style свършва и при <body>
+        self.interesting = re.compile(
+            rf"{self.interesting.pattern}|<body[\s/>]", re.IGNORECASE)
+
+    def handle_data(self, data):
+        if self._skip == 0:
+            self.out.append(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._skip = 0
+
+
+def html_to_text(html, chunk_size=65536):
+    """Текста от HTML без таговете, скриптовете и стиловете."""
+
+    parser = _HtmlTextParser()
+    for pos in range(0, len(html), chunk_size):
+        parser.feed(html[pos:pos+chunk_size])
+    parser.close()
+    return "".join(parser.out)
+
+
+_rtf_tokens_re = re.compile(
+    r"\\([a-zA-Z]+)(-?\d+)? ?|\\'([0-9a-fA-F]{2})|\\(.)|([{}])|[\r\n]+|([^\\{}\r\n]+)",
+    re.DOTALL)
+
+# групи (destinations), чието съдържание не е текст на документа
+_rtf_skip_destinations = {
+    "fonttbl", "colortbl", "stylesheet", "info", "pict", "object", "header",
+    "footer", "headerl", "headerr", "footerl", "footerr", "listtable",
+    "listoverridetable", "revtbl", "rsidtbl", "generator", "xmlnstbl", "themedata",
+    "datastore", "latentstyles", "fldinst", "filetbl", "mmathPr",
+}
+_rtf_default_encoding = "cp1252"
+_rtf_special_chars = {
+    "par": "\n", "line": "\n", "sect": "\n", "page": "\n", "row": "\n",
+    "cell": "\t", "tab": "\t", "emdash": "\u2014", "endash": "\u2013",
+    "lquote": "\u2018", "rquote": "\u2019", "ldblquote": "\u201C",
+    "rdblquote": "\u201D", "bullet": "\u2022",
+}
+
+
+def _rtf_encoding(codepage):
+    """Кодировката за \\ansicpgN; cp1252, ако Python не поддържа cpN."""
+
+    encoding = f"cp{codepage}"
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return _rtf_default_encoding
+    return encoding
+
+
+def rtf_to_text(rtf):
+    """Текста от RTF документ (bytes или str).
+
+    Прескачат се служебните групи (таблици с шрифтове, цветове, {\\* ...}),
+    \\'hh се декодират според \\ansicpg, а \\uN според Unicode. Двойките
+    UTF-16 surrogates от \\uN се събират в един символ, а единичните се
+    заместват с U+FFFD.
+    """
+
+    if isinstance(rtf, (bytes, bytearray, memoryview)):
+        rtf = bytes(rtf).decode("latin-1")
+
+    # pylint: disable=too-many-branches
+    # всеки вид token от RTF се обработва по различен начин
+    encoding = _rtf_default_encoding
+    stack = []
+    skip, uc_skip, uc, surrogates = False, 0, 1, False
+    out, pending = [], bytearray()
+
+    def flush():
+        if pending:
+            out.append(pending.decode(encoding, "replace"))
+            pending.clear()
+
+    for match in _rtf_tokens_re.finditer(rtf):
+        word, arg, hex_char, symbol, brace, text = match.groups()
+        if uc_skip > 0 and brace is None:
+            # заместващите символи след \\uN за четци без Unicode
+            if text is None:
+                if word is not None or symbol is not None or hex_char is not None:
+                    uc_skip -= 1
+                continue
+            text, uc_skip = text[uc_skip:], max(0, uc_skip - len(text))
+            if len(text) == 0:
+                continue
+
+        if brace is not None:
+            flush()
+            if brace == "{":
+                stack.append((skip, uc))
+            elif stack:
+                skip, uc = stack.pop()
+            uc_skip = 0
+        elif word is not None:
+            flush()
+            if word in _rtf_skip_destinations:
+                skip = True
+            elif word == "ansicpg" and arg is not None:
+                encoding = _rtf_encoding(arg)
+            elif word == "uc" and arg is not None:
+                uc = int(arg)
+            elif word == "u" and arg is not None:
+                if not skip:
+                    code = int(arg) & 0xFFFF
+                    surrogates = surrogates or 0xD800 <= code <= 0xDFFF
+                    out.append(chr(code))
+                uc_skip = uc
+            elif not skip and word in _rtf_special_chars:
+                out.append(_rtf_special_chars[word])
+        elif symbol is not None:
+            flush()
+            if symbol == "*":
+                skip = True
+            elif not skip and symbol in "\\{}":
+                out.append(symbol)
+            elif not skip and symbol == "~":
+                out.append("\u00A0")
+        elif hex_char is not None:
+            if not skip:
+                pending.append(int(hex_char, 16))
+        elif text is not None:
+            flush()
+            if not skip:
+                out.append(text)
+    flush()
+    out = "".join(out)
+    if surrogates:
+        out = out.encode("utf-16-le", "surrogatepass").decode("utf-16-le", "replace")
+    return out
+
+
 def test_compressed_rtf(test_fnm):
 
     def test_file(fnm):
@@ -0,0 +1,289 @@
+# -*- coding: UTF-8 -*-
+# vim:ft=python:et:ts=4:sw=4:ai
+
+import logging
+from struct import pack
+from uuid import UUID
+
+log = logging.getLogger(__name__)
+
+# Създаване на Compound File, обратното на readole.OLE
+# https://docs.microsoft.com/en-us/openspecs/windows_protocols/ms-cfb/
+# https://winprotocoldoc.blob.core.windows.net/productionwindowsarchives/MS-CFB/[MS-CFB].pdf
+
+SECTOR_SIZE = 512        # версия 3
+MINI_SECTOR_SIZE = 64
+MINI_STREAM_CUTOFF = 4096
+
+MAXREGSECT = 0xFFFFFFFA
+DIFSECT = 0xFFFFFFFC
+FATSECT = 0xFFFFFFFD
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+NOSTREAM = 0xFFFFFFFF
+
+# 2.6.3 Free (unused) Directory Entries: само нули, освен NOSTREAM за връзките
+FREE_DIR_ENTRY = b"".join((bytes(64 + 4), pack("<LLL", NOSTREAM, NOSTREAM, NOSTREAM),
+                           bytes(16 + 4 + 8 + 8 + 4 + 8)))
+
+
+class OLEWriter:
+    """Compound File (MS-CFB) версия 3, който се записва последователно.
+
+    Съдържанието на всеки stream се задава с bytes или с (размер, части),
+    където частите са итератор, който се чете едва при записа. Понеже
+    размерите са известни, разположението на всички сектори се изчислява
+    предварително и файлът се извежда на един проход, без seek, с точно
+    известен размер (виж chunks). Секторите на всеки stream са подредени
+    последователно: данните на големите streams, mini stream, Mini FAT,
+    директорията, DIFAT и FAT.
+    """
+
+    class Entry:
+        # pylint: disable=too-few-public-methods
+        # Описание на directory entry, без логика
+
+        def __init__(self, name, entry_type, clsid=None, size=0, chunks=()):
+            assert len(name) < 32, name
+            self.name = name
+            self.type = entry_type  # 1 Storage, 2 Stream, 5 Root
+            self.clsid = clsid
+            self.size = size
+            self.chunks = chunks
+            self.children = []
+            self.id = None
+            self.start = ENDOFCHAIN
+            self.left = self.right = self.child = NOSTREAM
+            self.color = 1  # black
+
+    class Storage(Entry):
+        def __init__(self, name, clsid=None, entry_type=1):
+            OLEWriter.Entry.__init__(self, name, entry_type, clsid)
+
+        def add_storage(self, name, clsid=None):
+            storage = OLEWriter.Storage(name, clsid)
+            self.children.append(storage)
+            return storage
+
+        def add_stream(self, name, data):
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                size, chunks = len(data), (data,)
+            else:
+                size, chunks = data
+            stream = OLEWriter.Entry(name, 2, size=size, chunks=chunks)
+            self.children.append(stream)
+            return stream
+
+    def __init__(self, clsid=None):
+        self.root = OLEWriter.Storage("Root Entry", clsid, entry_type=5)
+
+    def _entries(self):
+        entries = []
+
+        def trip(entry):
+            entry.id = len(entries)
+            entries.append(entry)
+            for child in entry.children:
+                trip(child)
+
+        trip(self.root)
+        return entries
+
+    @staticmethod
+    def _name_key(entry):
+        # 2.6.4 Red-Black Tree: първо по дължина, после по главни букви
+        return len(entry.name), entry.name.upper()
+
+    def _build_tree(self, storage):
+        """Балансирано двоично дърво от децата на storage (2.6.4 Red-Black Tree).
+
+        Възлите на най-дълбокото ниво са червени, останалите черни, така че
+        всички пътища имат еднакъв брой черни възли.
+        """
+
+        children = sorted(storage.children, key=self._name_key)
+        depths = {}
+
+        def build(lo, hi, depth):
+            if lo >= hi:
+                return NOSTREAM
+            mid = (lo + hi) // 2
+            node = children[mid]
+            depths[node.id] = depth
+            node.left = build(lo, mid, depth + 1)
+            node.right = build(mid + 1, hi, depth + 1)
+            return node.id
+
+        storage.child = build(0, len(children), 0)
+        if children:
+            max_depth = max(depths.values())
+            for node in children:
+                node.color = 0 if depths[node.id] == max_depth and max_depth > 0 else 1
+        for child in children:
+            if child.type == 1:
+                self._build_tree(child)
+
+    def _layout(self):
+        entries = self._entries()
+        self._build_tree(self.root)
+        streams = [x for x in entries if x.type == 2]
+        large = [x for x in streams if x.size >= MINI_STREAM_CUTOFF]
+        small = [x for x in streams if 0 < x.size < MINI_STREAM_CUTOFF]
+
+        def sectors(size, sector_size=SECTOR_SIZE):
+            return (size + sector_size - 1) // sector_size
+
+        # Mini stream: малките streams в сектори по 64 байта
+        mini_fat = []
+        for entry in small:
+            entry.start = len(mini_fat)
+            count = sectors(entry.size, MINI_SECTOR_SIZE)
+            mini_fat.extend(range(entry.start + 1, entry.start + count))
+            mini_fat.append(ENDOFCHAIN)
+        mini_size = len(mini_fat) * MINI_SECTOR_SIZE
+
+        n_large = sum(sectors(x.size) for x in large)
+        n_mini = sectors(mini_size)
+        n_minifat = sectors(len(mini_fat) * 4)
+        n_dir = sectors(len(entries) * 128)
+        n_fat = n_difat = 0
+        while True:
+            total = n_large + n_mini + n_minifat + n_dir + n_fat + n_difat
+            fat_needed = sectors(total * 4)
+            difat_needed = max(0, sectors((fat_needed - 109) * 4, SECTOR_SIZE - 4))
+            if (fat_needed, difat_needed) == (n_fat, n_difat):
+                break
+            n_fat, n_difat = fat_needed, difat_needed
+
+        fat = []
+
+        def chain(count, mark=None):
+            start = len(fat)
+            if mark is not None:
+                fat.extend([mark] * count)
+            elif count > 0:
+                fat.extend(range(start + 1, start + count))
+                fat.append(ENDOFCHAIN)
+            return start if count > 0 else ENDOFCHAIN
+
+        for entry in large:
+            entry.start = chain(sectors(entry.size))
+        self.root.start = chain(n_mini)
+        self.root.size = mini_size
+        minifat_start = chain(n_minifat)
+        dir_start = chain(n_dir)
+        difat_start = chain(n_difat, DIFSECT)
+        fat_start = chain(n_fat, FATSECT)
+        assert len(fat) <= n_fat * (SECTOR_SIZE // 4) <= MAXREGSECT
+
+        self._entries_list = entries
+        self._large = large
+        self._small = small
+        self._mini_fat = mini_fat
+        self._fat = fat
+        self._fat_sectors = list(range(fat_start, fat_start + n_fat)) if n_fat else []
+        self._difat_start = difat_start
+        self._n_difat = n_difat
+        self._minifat_start = minifat_start
+        self._n_minifat = n_minifat
+        self._dir_start = dir_start
+        return 1 + len(fat)
+
+    def _header(self):
+        # 2.2 Compound File Header
+        difat = self._fat_sectors[:109]
+        difat = difat + [FREESECT] * (109 - len(difat))
+        return b"".join((
+            bytes((0xD0, 0xCF, 0x11, 0xE0, 0xA1, 0xB1, 0x1A, 0xE1)),
+            bytes(16),
+            pack("<HHHHH", 0x003E, 0x0003, 0xFFFE, 9, 6),
+            bytes(6),
+            pack("<LLLL", 0, len(self._fat_sectors), self._dir_start, 0),
+            pack("<L", MINI_STREAM_CUTOFF),
+            pack("<LL", self._minifat_start if self._n_minifat else ENDOFCHAIN,
+                 self._n_minifat),
+            pack("<LL", self._difat_start if self._n_difat else ENDOFCHAIN, self._n_difat),
+            pack("<109L", *difat),
+        ))
+
+    @staticmethod
+    def _dir_entry(entry):
+        # 2.6.1 Compound File Directory Entry
+        name = entry.name.encode("UTF-16LE") + b"\0\0"
+        clsid = entry.clsid.bytes_le if entry.clsid is not None else bytes(16)
+        return b"".join((
+            name.ljust(64, b"\0"),
+            pack("<HBB", len(name), entry.type, entry.color),
+            pack("<LLL", entry.left, entry.right, entry.child),
+            clsid,
+            bytes(4 + 8 + 8),  # State Bits, Creation Time, Modified Time
+            pack("<LQ", entry.start, entry.size),
+        ))
+
+    @staticmethod
+    def _pad(size, sector_size=SECTOR_SIZE):
+        rest = size % sector_size
+        return bytes(sector_size - rest) if rest else b""
+
+    def _sector_chunks(self):
+        yield self._header()
+
+        # данните на големите streams
+        for entry in self._large:
+            written = 0
+            for chunk in entry.chunks:
+                written += len(chunk)
+                yield chunk
+            assert written == entry.size, entry.name
+            yield self._pad(entry.size)
+
+        # mini stream
+        written = 0
+        for entry in self._small:
+            size = 0
+            for chunk in entry.chunks:
+                size += len(chunk)
+                yield chunk
+            assert size == entry.size, entry.name
+            pad = self._pad(size, MINI_SECTOR_SIZE)
+            written += size + len(pad)
+            yield pad
+        yield self._pad(written)
+
+        # Mini FAT
+        if self._mini_fat:
+            data = pack(f"<{len(self._mini_fat)}L", *self._mini_fat)
+            yield data + self._pad(len(data)).replace(b"\0", b"\xff")
+
+        # директорията
+        data = b"".join(self._dir_entry(x) for x in self._entries_list)
+        yield data + FREE_DIR_ENTRY * (len(self._pad(len(data))) // len(FREE_DIR_ENTRY))
+
+        # DIFAT: по 127 FAT сектора и следващия DIFAT сектор
+        rest = self._fat_sectors[109:]
+        for ix in range(self._n_difat):
+            part = rest[ix*127:(ix+1)*127]
+            part = part + [FREESECT] * (127 - len(part))
+            next_sector = ENDOFCHAIN
+            if ix + 1 < self._n_difat:
+                next_sector = self._difat_start + ix + 1
+            yield pack("<128L", *part, next_sector)
+
+        # FAT
+        fat = self._fat + [FREESECT] * (len(self._fat_sectors) * 128 - len(self._fat))
+        yield pack(f"<{len(fat)}L", *fat)
+
+    def chunks(self):
+        """Връща (размер, части) на файла."""
+
+        n_sectors = self._layout()
+        return n_sectors * SECTOR_SIZE, self._sector_chunks()
+
+    def write(self, fout):
+        _size, chunks = self.chunks()
+        for chunk in chunks:
+            fout.write(chunk)
+
+
+# [MS-OXMSG] 2.1 CLSID на .msg файл
+MSG_CLSID = UUID("00020D0B-0000-0000-C000-000000000046")
@@ -0,0 +1,97 @@
+"""Тестове на FilterEvaluator върху NidSpace с десет съобщения."""
+
+import pytest
+
+from readms.pstindex import NidSpace
+from readms.pstmbox import FilterEvaluator
+
+
+class FakeCategories:
+
+    def __init__(self, categories):
+        self._categories = categories
+
+    def lookup(self, category=None):
+        if category is None:
+            return {nid for nids in self._categories.values() for nid in nids}
+        return self._categories.get(category, set())
+
+
+class FakeMbox:
+    """Само методите на MboxCacheEntry, които използва FilterEvaluator."""
+
+    def __init__(self):
+        self._nid_space = NidSpace(range(1, 11))
+        self.tagged = {2, 4, 6}
+        self.calls = []
+
+    def to_bitmap(self, nids):
+        return self._nid_space.bitmap(nids)
+
+    def tags_bitmap(self, tag=None):
+        return self.to_bitmap({5} if tag == "red" else self.tagged)
+
+    def get_category_index(self):
+        return FakeCategories({"work": {1, 2, 3}, "home": {3, 4}})
+
+    def _search_words(self, search, match_mode, apply_mode, folder):
+        self.calls.append((search, match_mode, apply_mode, folder))
+        return {nid for nid in range(1, 11) if nid % 2 == (search == "odd")}
+
+
+@pytest.fixture
+def mbox():
+    return FakeMbox()
+
+
+@pytest.fixture
+def evaluator(mbox):
+    return FilterEvaluator(mbox)
+
+
+def test_empty_plan_is_all_messages(evaluator):
+    assert set(evaluator.evaluate([])) == set(range(1, 11))
+
+
+def test_first_add_starts_from_empty(evaluator):
+    assert set(evaluator.evaluate([("A", {"tag": "red"})])) == {5}
+
+
+def test_first_filter_starts_from_all(evaluator):
+    assert set(evaluator.evaluate([("M", {"tags": True})])) == {1, 3, 5, 7, 8, 9, 10}
+
+
+def test_without_tags(evaluator):
+    assert set(evaluator.evaluate([("F", {"tags": False})])) == {1, 3, 5, 7, 8, 9, 10}
+    assert set(evaluator.evaluate([("F", {"tags": True})])) == {2, 4, 6}
+
+
+def test_without_categories(evaluator):
+    assert set(evaluator.evaluate([("F", {"categories": False})])) == {5, 6, 7, 8, 9, 10}
+
+
+def test_chain(evaluator):
+    filters = [("A", {"category": "work"}),
+               ("A", {"tag": "red"}),
+               ("M", {"search": "odd", "match_mode": 2})]
+    assert set(evaluator.evaluate(filters)) == {2}
+
+
+def test_sources_in_one_filter_are_anded(evaluator):
+    filters = [("F", {"category": "work", "tags": True})]
+    assert set(evaluator.evaluate(filters)) == {2}
+
+
+def test_prefix_is_reused(evaluator, mbox):
+    filters = [("F", {"search": "odd"}), ("M", {"tag": "red"})]
+    assert set(evaluator.evaluate(filters)) == {1, 3, 7, 9}
+    filters[1] = ("M", {"category": "work"})
+    assert set(evaluator.evaluate(filters)) == {5, 7, 9}
+    assert mbox.calls == [("odd", 1, 1, None)]
+
+
+def test_unknown_oper_or_param(evaluator):
+    with pytest.raises(KeyError):
+        evaluator.evaluate([("X", {"tag": "red"})])
+    with pytest.raises(KeyError):
+        evaluator.evaluate([("F", {"colour": "red"})])
@@ -0,0 +1,88 @@
+"""Тестове на mboxpst export: архивът на stdout не се смесва с други съобщения."""
+
+import io
+import os
+import subprocess
+import sys
+import tarfile
+from datetime import datetime
+from pathlib import Path
+
+from pytz import utc as UTC
+
+from readms import mboxpst
+from readms.readpst import PropertyValue
+
+MESSAGES = {
+    0x200024: {"ConversationTopic": "Първо", "Body": "текст 1\nFrom x\n",
+               "MessageDeliveryTime": datetime(2021, 1, 1, tzinfo=UTC)},
+    0x200044: {"ConversationTopic": "Второ", "Body": "текст 2\n",
+               "MessageDeliveryTime": datetime(2021, 1, 2, tzinfo=UTC)},
+    0x8025: {"AttachLongFilename": "a.pdf",
+             "AttachDataObject": PropertyValue.BinaryValue(b"%PDF" + bytes(range(256)))},
+}
+ATTACHMENTS = {0x200024: [0x8025]}
+
+
+class FakeNDB:
+    def __init__(self, file_name, index_dir=None):
+        self._file_name = file_name
+        self._index_dir = index_dir
+        self._nbt = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def nid_offset(nid):
+        return nid
+
+    @staticmethod
+    def schedule_reads(items, key=None):
+        return iter(items)
+
+    @staticmethod
+    def list_nids(_type, nid):
+        return [(anid, None) for anid in ATTACHMENTS.get(nid, ())]
+
+
+class FakePC:
+    def __init__(self, ndb, nid, hnid=None):
+        self._values = MESSAGES[nid]
+
+    def get_value(self, name):
+        return self._values.get(name)
+
+    def get_value_safe(self, name, default=None):
+        return self._values.get(name, default)
+
+    def alt_name(self, *names):
+        return next((x for x in names if x in self._values), None)
+
+    def get_stream(self, name):
+        value = self._values.get(name)
+        if value is None:
+            return None
+        return len(value.data), iter([value.data])
+
+
+def run_export():
+    mboxpst.NDBLayer = FakeNDB
+    mboxpst.PropertyContext = FakePC
+    mboxpst.cli(["x.pst", "export", "-", *map(str, MESSAGES), "--plain", "--eml"])
+
+
+def test_export_tar_stdout():
+    # Отделен процес, защото съобщенията при зареждане на модулите са преди теста
+    tests_dir = Path(__file__).parent
+    result = subprocess.run(
+        [sys.executable, "-c", "import test_mboxpst; test_mboxpst.run_export()"],
+        cwd=tests_dir.parent, capture_output=True, check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join((str(tests_dir), str(tests_dir.parent)))})
+    with tarfile.open(fileobj=io.BytesIO(result.stdout), mode="r|") as tar:
+        names = {x.name for x in tar}
+    assert {"2097188/body.txt", "2097188/a.pdf", "2097188.eml",
+            "2097220/body.txt", "2097220.eml"} <= names
@@ -0,0 +1,65 @@
+"""Тестове на RowCacheIndex: кешираният ред съвпада с прочетения от PC."""
+
+from struct import pack
+
+import pytest
+
+from readms import pstindex
+from readms.pstindex import RowCacheIndex, datetime_from_filetime
+from readms.readpst import PropertyValue
+
+# 2024-03-31 05:30:15.1234567 UTC, в деня на преминаване към лятно време
+FILETIME = 133_563_366_151_234_567
+
+
+class FakeNDB:
+    def __init__(self, messages):
+        self._nbt = [{"nid": nid, "nidParent": 0x8022, "typeCode": "NORMAL_MESSAGE"}
+                     for nid in messages]
+
+    @staticmethod
+    def schedule_reads(items, key=None):
+        return reversed(items)
+
+
+class FakePC:
+    def __init__(self, messages, nid):
+        self._values = messages[nid]
+
+    def get_value_safe(self, name):
+        return self._values.get(name)
+
+
+@pytest.fixture
+def messages():
+    return {
+        0x200024: {"MessageDeliveryTime": PropertyValue._read_Time(pack("<Q", FILETIME)),
+                   "Subject": "Първо", "MessageSizeExtended": 1234, "Body": "текст"},
+        0x200044: {"MessageDeliveryTime": PropertyValue._read_Time(
+                       pack("<Q", FILETIME + 86_400 * 10_000_000 - 1)),
+                   "Subject": "Второ", "Importance": 2},
+    }
+
+
+def test_datetime_from_filetime():
+    assert datetime_from_filetime(FILETIME) == PropertyValue._read_Time(pack("<Q", FILETIME))
+    assert datetime_from_filetime(FILETIME).microsecond == 0
+
+
+def test_cached_row(tmp_path, monkeypatch, messages):
+    monkeypatch.setattr(pstindex, "PropertyContext", lambda ndb, nid: FakePC(messages, nid))
+    monkeypatch.setattr(pstindex, "message_body_text", lambda pc: pc.get_value_safe("Body"))
+    index = RowCacheIndex()
+    index.create(FakeNDB(messages))
+    index.save(tmp_path / "rows.idx")
+    try:
+        for nid in messages:
+            pc = FakePC(messages, nid)
+            fresh = [pc.get_value_safe(name) for name in RowCacheIndex.FIELDS]
+            cached = index.get_row(nid, RowCacheIndex.FIELDS)
+            assert cached == fresh
+            assert [str(x) for x in cached] == [str(x) for x in fresh]
+        assert index.get_snippet(0x200024) == "текст"
+        assert index.get_row(0x200064, RowCacheIndex.FIELDS) is None
+    finally:
+        index.close()
@@ -0,0 +1,55 @@
+"""Тестове на rtf_to_text и html_to_text."""
+
+from readms.readutl import html_to_text, rtf_to_text
+
+
+def rtf(body):
+    return ("{\\rtf1\\ansi " + body + "}").encode("ascii")
+
+
+def test_rtf_plain_text():
+    assert rtf_to_text(rtf("Hello\\par World")) == "Hello\nWorld"
+
+
+def test_rtf_skips_destinations():
+    text = rtf("{\\fonttbl{\\f0 Arial;}}{\\*\\generator gen;}Text")
+    assert rtf_to_text(text) == "Text"
+
+
+def test_rtf_codepage():
+    assert rtf_to_text(rtf("\\ansicpg1251 \\'e0\\'e1")) == "аб"
+
+
+def test_rtf_unknown_codepage_falls_back_to_cp1252():
+    assert rtf_to_text(rtf("\\ansicpg10000 caf\\'e9")) == "café"
+    assert rtf_to_text(rtf("\\ansicpg0 caf\\'e9")) == "café"
+
+
+def test_rtf_unicode_skips_fallback_chars():
+    assert rtf_to_text(rtf("\\uc1\\u1072?\\u1073?")) == "аб"
+
+
+def test_rtf_surrogate_pair():
+    assert rtf_to_text(rtf("\\u-10179?\\u-8704?")) == "\U0001F600"
+
+
+def test_rtf_unpaired_surrogates():
+    assert rtf_to_text(rtf("a\\u-10179? b\\u-8704?")) == "a� b�"
+
+
+def test_html_skips_head_and_script():
+    html = "<html><head><title>T</title></head><body>a<script>x<y</script>b</body>"
+    assert html_to_text(html) == "ab"
+
+
+def test_html_body_ends_unclosed_head():
+    assert html_to_text("<head><style>p {}<body>Hello<p>World") == "Hello\nWorld"
+
+
+def test_html_body_ends_unclosed_script():
+    assert html_to_text("<head><script>if (i<n) x();<body>Body") == "Body"
+
+
+def test_html_unclosed_script_at_eof():
+    assert html_to_text("text<script>var x") == "text"
+    assert html_to_text("<p>next") == "\nnext"
@@ -0,0 +1,107 @@
+"""Тестове на OLEWriter: записаният файл се чете обратно с readole.OLE."""
+
+from struct import pack, unpack_from
+
+import pytest
+
+from readms.mboxpst import msg_properties
+from readms.readole import OLE
+from readms.writeole import MSG_CLSID, NOSTREAM, SECTOR_SIZE, OLEWriter
+
+
+def write_ole(tmp_path, ole):
+    file_name = tmp_path / "test.msg"
+    size, chunks = ole.chunks()
+    with open(file_name, "wb") as fout:
+        fout.writelines(chunks)
+    assert file_name.stat().st_size == size
+    return file_name
+
+
+@pytest.fixture
+def streams():
+    return {
+        "small": b"abc",
+        "empty": b"",
+        "mini": bytes(range(256)) * 15,
+        "large": bytes(range(256)) * 40 + b"x",
+    }
+
+
+def test_round_trip(tmp_path, streams):
+    ole = OLEWriter(MSG_CLSID)
+    for name, data in streams.items():
+        ole.root.add_stream(name, data)
+    storage = ole.root.add_storage("__attach_version1.0_#00000000")
+    storage.add_stream("nested", (5, iter([b"ab", b"cde"])))
+
+    with OLE(write_ole(tmp_path, ole)) as reader:
+        root = {x.name: x for x in reader.dire_childs(0)}
+        assert set(root) == {*streams, "__attach_version1.0_#00000000"}
+        for name, data in streams.items():
+            assert bytes(reader.dire_read(root[name])) == data
+        attach = root["__attach_version1.0_#00000000"]
+        assert attach.type_name == "Storage"
+        nested = reader.dire_childs(attach.id)
+        assert [x.name for x in nested] == ["nested"]
+        assert bytes(reader.dire_read(nested[0])) == b"abcde"
+
+
+def test_free_directory_entries(tmp_path):
+    ole = OLEWriter()
+    ole.root.add_stream("one", b"1")
+    with open(write_ole(tmp_path, ole), "rb") as fin:
+        data = fin.read()
+    dir_start = unpack_from("<L", data, 48)[0]
+    directory = data[SECTOR_SIZE * (dir_start + 1):SECTOR_SIZE * (dir_start + 2)]
+
+    # Root Entry, one и две свободни записа
+    for pos in range(256, SECTOR_SIZE, 128):
+        entry = directory[pos:pos + 128]
+        assert unpack_from("<HBB", entry, 64) == (0, 0, 0)
+        assert unpack_from("<LLL", entry, 68) == (NOSTREAM, NOSTREAM, NOSTREAM)
+        assert entry[:64] == bytes(64)
+        assert entry[80:] == bytes(48)
+
+
+def test_many_streams_tree(tmp_path):
+    ole = OLEWriter()
+    names = [f"__substg1.0_{ix:04X}001F" for ix in range(40)]
+    for name in names:
+        ole.root.add_stream(name, name.encode())
+    with OLE(write_ole(tmp_path, ole)) as reader:
+        children = reader.dire_childs(0)
+        assert sorted(x.name for x in children) == names
+        for dire in children:
+            assert bytes(reader.dire_read(dire)) == dire.name.encode()
+
+
+class FakePC:
+    def __init__(self, props):
+        self._props = {ptag: {"propType": ptype} for ptag, (ptype, _) in props.items()}
+        self._buffers = {ptag: buf for ptag, (_, buf) in props.items()}
+
+    def get_buffer_stream(self, ptag):
+        buf = self._buffers[ptag]
+        return len(buf), iter([buf[:5], buf[5:]])
+
+
+@pytest.mark.parametrize(("ptype", "values", "fmt"), [
+    (0x1003, (2, 5, 6), "<3L"),
+    (0x1003, (1, 5, 7), "<3L"),
+    (0x1014, (2**40, 3), "<2Q"),
+    (0x1040, (116444736000000000,), "<Q"),
+    (0x1048, (b"g" * 16, b"h" * 16), "<16s16s"),
+])
+def test_msg_multiple_fixed(tmp_path, ptype, values, fmt):
+    packed = pack(fmt, *values)
+    ole = OLEWriter(MSG_CLSID)
+    msg_properties(None, ole.root, FakePC({0x6801: (ptype, packed)}), bytes(8))
+
+    with OLE(write_ole(tmp_path, ole)) as reader:
+        root = {x.name: x for x in reader.dire_childs(0)}
+        stream = bytes(reader.dire_read(root[f"__substg1.0_6801{ptype:04X}"]))
+        props = bytes(reader.dire_read(root["__properties_version1.0"]))
+    assert stream == packed
+    assert unpack_from(fmt, stream) == values
+    assert unpack_from("<HHLL", props, 8) == (ptype, 0x6801, 6, len(packed))